@@ -61,6 +61,26 @@ def create_app(config_class=Config):
     # having it defined here is convenient because then we can access it from current_app anywhere in the app
     app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
 
+    # outgoing emails are queued here and sent in batches by a few background threads, see app/email.py
+    from app.email import MailQueue
+    app.mail_queue = MailQueue(app)
+
+    # who follows whom, cached per user (see app/follow_cache.py)
+    from app.follow_cache import make_follow_cache
+    app.follow_cache = make_follow_cache(app)
+
+    # general purpose cache, local LRU in front of redis (see app/cache.py)
+    from app.cache import Cache
+    app.cache = Cache(app)
+
+    # api token -> user id and expiry (see app/token_cache.py)
+    from app.token_cache import make_token_cache
+    app.token_cache = make_token_cache(app)
+
+    # password hashing runs on a few threads of its own (see app/passwords.py)
+    from app.passwords import PasswordHasher
+    app.password_hasher = PasswordHasher(app)
+
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
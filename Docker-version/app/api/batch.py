@@ -0,0 +1,37 @@
+from flask import request, current_app, abort
+
+from app.api.errors import bad_request
+
+# batch reads: ?ids=1,2,3 on a collection endpoint fetches exactly those resources with one IN query, instead of one
+# request per resource. items come back in the order asked for, and ids that don't exist are listed under
+# _meta.missing rather than failing the whole request
+
+
+def get_ids():
+    # the ids asked for, without repeats, or None when there's no ?ids=
+    if 'ids' not in request.args:
+        return None
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',') if id.strip()]
+    except ValueError:
+        abort(bad_request('ids must be a comma separated list of numbers'))
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > current_app.config['API_BATCH_MAX']:
+        abort(bad_request('at most {} ids at a time'.format(current_app.config['API_BATCH_MAX'])))
+    return ids
+
+
+def batch_query(model, ids):
+    return model.query.filter(model.id.in_(ids))
+
+
+def to_batch_dict(model, ids, fieldset):
+    found = {item.id: item for item in batch_query(model, ids)} if ids else {}
+    items = [found[id] for id in ids if id in found]
+    return {
+        'items': model.to_dicts(items, fieldset),
+        '_meta': {
+            'missing': [id for id in ids if id not in found]
+        }
+    }
+
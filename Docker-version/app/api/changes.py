@@ -0,0 +1,26 @@
+from flask import request, url_for, current_app
+
+from app import changes
+from app.api import bp
+from app.api.auth import token_auth
+from app.serializers import json_response
+
+
+@bp.route('/changes', methods=['GET'])
+@token_auth.login_required
+def get_changes():
+    # what changed since the cursor from last time (start from 0), oldest first - see app/changes.py
+    # with ?wait=<seconds> the request is held open until something changes (long polling), so consumers don't have
+    # to keep asking. note each waiting consumer keeps a server worker busy while it waits
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 100)) #between 1 and 100
+    wait = min(request.args.get('wait', 0, type=float), current_app.config['CHANGE_LOG_MAX_WAIT'])
+    rows = changes.read(since, limit, wait)
+    cursor = rows[-1].id if rows else since
+    return json_response({
+        'items': [row.to_dict() for row in rows],
+        'cursor': cursor,
+        '_links': {
+            'next': url_for('api.get_changes', since=cursor, limit=limit)
+        }
+    })
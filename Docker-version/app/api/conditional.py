@@ -0,0 +1,66 @@
+from functools import wraps
+
+from flask import request, make_response, abort
+
+from app import db
+
+# conditional GET: clients send back the ETag (If-None-Match) or Last-Modified (If-Modified-Since) they got last time,
+# and if nothing changed they get an empty 304 instead of the whole thing again
+# the validator works out the etag and last modified time from a couple of columns or aggregates - much cheaper than
+# the serialization we skip
+
+
+def conditional(validator):
+    # validator gets the same arguments as the view and returns (etag, last_modified), or None for a 404
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            validators = validator(*args, **kwargs)
+            if validators is None:
+                abort(404)
+            etag, last_modified = validators
+            if last_modified is not None:
+                # http dates only go down to the second
+                last_modified = last_modified.replace(microsecond=0)
+            # If-None-Match wins when a client sends both
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = last_modified is not None and request.if_modified_since is not None and \
+                    last_modified <= request.if_modified_since.replace(tzinfo=None)
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
+
+
+def row_validator(model, id):
+    # for a single row: its version and when it last changed
+    row = db.session.query(model.version, model.updated_at).filter(model.id == id).first()
+    if row is None:
+        return None
+    return '{}-{}-{}'.format(model.__tablename__, id, row.version), row.updated_at
+
+
+def collection_validator(query, model, next_links=False):
+    # for a list: how many rows and when the latest one changed. adding or changing a row changes the second,
+    # removing one the first - which a date alone can't show, so lists only get an etag
+    # with next_links the items link to the row with the next id (see Post.to_dict). that row can be anyone's, and come
+    # or go without anything in the list changing - so the ids of the items that have one are added up in the etag too
+    columns = [db.func.count(model.id), db.func.max(model.updated_at)]
+    if next_links:
+        following = db.aliased(model)
+        has_next = db.session.query(following.id).filter(following.id == model.id + 1).exists()
+        columns.append(db.func.sum(db.case([(has_next, model.id)], else_=0)))
+    row = query.with_entities(*columns).order_by(None).first()
+    count, updated_at = row[:2]
+    etag = '{}-{}-{}'.format(model.__tablename__, count, updated_at.isoformat() if updated_at else '')
+    if next_links:
+        etag = '{}-{}'.format(etag, row[2] or 0)
+    return etag, None
@@ -1,5 +1,6 @@
-from flask import jsonify, request
+from flask import request
 from werkzeug.http import HTTP_STATUS_CODES
+from app.serializers import json_response
 
 
 
@@ -13,6 +14,6 @@ def error_response(status_code, message=None):
     payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
     if message:
         payload['message'] = message
-    response = jsonify(payload) #convert into a nice json object
+    response = json_response(payload) #convert into a nice json object
     response.status_code = status_code
     return response
@@ -0,0 +1,47 @@
+from flask import request, abort
+
+from app.api.errors import bad_request
+from app.serializers import Fieldset
+
+# sparse fieldsets and expansions:
+#   ?fields=id,username           only these fields (the model's api_fields lists what there is)
+#   ?expand=author                include related resources as well (the model's api_expansions)
+#   ?expand=author&fields=id,body,author.username
+#                                 fields of an expanded resource are picked with a prefix
+# anything we don't know about is a 400 rather than being ignored, so typos don't go unnoticed
+
+
+def _names(value):
+    return [name.strip() for name in value.split(',') if name.strip()] if value else []
+
+
+def _fieldset(model, names, expand=(), args=None):
+    nested = {}
+    fields = []
+    for name in names:
+        prefix, _, rest = name.partition('.')
+        if rest:
+            nested.setdefault(prefix, []).append(rest)
+        elif name in model.api_fields:
+            fields.append(name)
+        else:
+            abort(bad_request('unknown field {}'.format(name)))
+    expansions = {}
+    for name in expand:
+        if name not in model.api_expansions:
+            abort(bad_request('cannot expand {}'.format(name)))
+        expansions[name] = _fieldset(model.api_expansions[name], nested.pop(name, []))
+    if nested:
+        abort(bad_request('{} is not expanded'.format(', '.join(sorted(nested)))))
+    # only asking for fields of an expansion leaves the resource's own fields alone
+    return Fieldset(fields or None, expansions, args)
+
+
+def get_fieldset(model):
+    args = {name: request.args[name] for name in ('fields', 'expand') if request.args.get(name)}
+    return _fieldset(model, _names(args.get('fields')), _names(args.get('expand')), args)
+
+
+def expanding(name):
+    # for validators - an expanded resource changing changes the response too
+    return name in _names(request.args.get('expand'))
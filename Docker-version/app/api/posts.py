@@ -1,19 +1,64 @@
-from flask import jsonify, request, url_for
+from elasticsearch import ElasticsearchException
+from flask import request, url_for, current_app
 
 from app import db
 from app.api import bp
 from app.api.auth import token_auth
+from app.api.batch import get_ids, batch_query, to_batch_dict
+from app.api.conditional import conditional, row_validator, collection_validator
+from app.api.errors import bad_request
+from app.api.fields import get_fieldset, expanding
 from app.models import Post, User
+from app.search import add_many_to_index
+from app.serializers import json_response, url
+
+
+def post_validator(id):
+    validators = row_validator(Post, id)
+    if validators is None:
+        return None
+    etag, last_modified = validators
+    # the representation links to the next post if there is one
+    has_next = Post.next_ids([id]) != set()
+    etag = '{}-{}'.format(etag, int(has_next))
+    if expanding('author'):
+        author = db.session.query(User.version, User.updated_at).join(Post.author).filter(Post.id == id).first()
+        if author is not None:
+            etag = '{}-{}'.format(etag, author.version)
+            last_modified = max(last_modified, author.updated_at) if last_modified and author.updated_at else None
+    return etag, last_modified
+
+
+def posts_validator():
+    ids = get_ids()
+    if ids is not None:
+        etag, last_modified = collection_validator(batch_query(Post, ids), Post, next_links=True)
+        if expanding('author'):
+            authors = User.query.join(Post, Post.user_id == User.id).filter(Post.id.in_(ids))
+            etag = '{}-{}'.format(etag, collection_validator(authors, User)[0])
+        return etag, last_modified
+    # all the posts are by the current user, so with ?expand=author their version matters as well
+    user = token_auth.current_user()
+    etag, last_modified = collection_validator(Post.query.filter_by(user_id=user.id), Post, next_links=True)
+    if expanding('author'):
+        etag = '{}-{}'.format(etag, db.session.query(User.version).filter_by(id=user.id).scalar())
+    return etag, last_modified
 
 
 @bp.route('/posts/<int:id>', methods=['GET'])
+@conditional(post_validator)
 def get_post(id):
-    return jsonify(Post.query.get_or_404(id).to_dict())
+    return json_response(Post.query.get_or_404(id).to_dict(fieldset=get_fieldset(Post)))
 
 
 @bp.route('/posts', methods=['GET'])
 @token_auth.login_required
+@conditional(posts_validator)
 def get_posts():
+    # ?ids=1,2,3 fetches those posts, whoever wrote them (see app/api/batch.py)
+    ids = get_ids()
+    if ids is not None:
+        return json_response(to_batch_dict(Post, ids, get_fieldset(Post)))
     # going to fetch all posts for a given user
     # I first wanted to get the token and then use it in .filter_by() to find the right user - but then I realized there's an easier way
     user = token_auth.current_user()
@@ -21,16 +66,16 @@ def get_posts():
     per_page = min(request.args.get('per_page', 10, type=int), 100) #not more than 100
     # the next tricky bit was figuring out posts below
     posts = Post.query.filter_by(user_id=user.id)
-    data = Post.to_collection_dict(posts, page, per_page, 'api.get_posts')
-    return jsonify(data)
+    data = Post.to_collection_dict(posts, page, per_page, 'api.get_posts', fieldset=get_fieldset(Post))
+    return json_response(data)
 
 
 @bp.route('/posts', methods=['POST'])
 @token_auth.login_required
 def create_post():
     # we need the user here coz we need to know who to assign as author of the post
-    # so we once again fetch them from the token
-    user = token_auth.current_user()
+    # so we once again fetch them from the token (.user is the full User, which the post needs as its author)
+    user = token_auth.current_user().user
     data = request.get_json() or {}
 
     post = Post()
@@ -38,20 +83,71 @@ def create_post():
     db.session.add(post)
     db.session.commit()
 
-    response = jsonify(post.to_dict())
+    response = json_response(post.to_dict())
     response.status_code = 201
     response.headers['Location'] = url_for('api.get_post', id=post.id)
     return response
 
 
+def post_error(item):
+    # what's wrong with one post of a bulk request, if anything
+    if not isinstance(item, dict):
+        return 'each post must be an object'
+    if not isinstance(item.get('body'), str) or not item['body'].strip():
+        return 'body is required'
+    if len(item['body']) > Post.body.type.length:
+        return 'body is longer than {} characters'.format(Post.body.type.length)
+    if item.get('language') is not None and (not isinstance(item['language'], str) or len(item['language']) > 5):
+        return 'language must be a language code'
+    return None
+
+
+@bp.route('/posts/bulk', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    # for importers - a list of up to API_BULK_MAX posts in one request, all inserted in one transaction
+    # each post is checked on its own: the response has a result for each, in the same order, and is a 201 if they
+    # were all created or a 207 if some of them weren't
+    user = token_auth.current_user().user
+    data = request.get_json()
+    if not isinstance(data, list) or not data:
+        return bad_request('expected a list of posts')
+    if len(data) > current_app.config['API_BULK_MAX']:
+        return bad_request('at most {} posts at a time'.format(current_app.config['API_BULK_MAX']))
+
+    errors = [post_error(item) for item in data]
+    valid = [i for i, error in enumerate(errors) if error is None]
+    created = Post.insert_many(user, [data[i] for i in valid])
+    db.session.commit()
+
+    # insert_many hands back one post per item, in order
+    posts = dict(zip(valid, created))
+    results = []
+    for i, error in enumerate(errors):
+        if error is not None:
+            results.append({'status': 400, 'message': error})
+            continue
+        post = posts[i]
+        results.append({'status': 201, 'id': post.id, '_links': {'self': url('api.get_post', post.id)}})
+    try:
+        add_many_to_index(Post.__tablename__, created)
+    except ElasticsearchException:
+        # the posts are in, they just won't turn up in searches until the next reindex
+        current_app.logger.error('could not index bulk posts', exc_info=True)
+
+    response = json_response({'items': results})
+    response.status_code = 201 if len(created) == len(results) else 207
+    return response
+
+
 @bp.route('/posts/<int:id>', methods=['PUT'])
 @token_auth.login_required
 def update_post(id):
-    user = token_auth.current_user()
+    user = token_auth.current_user().user
     data = request.get_json() or {}
 
     post = Post.query.filter_by(id=id).first()
     post.from_dict(data, user)
     db.session.commit()
 
-    return jsonify(post.to_dict())
\ No newline at end of file
+    return json_response(post.to_dict())
\ No newline at end of file
@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from flask import Response, stream_with_context
+
+from app.serializers import dumps
+
+# streaming responses for clients that want a whole collection rather than one page of it: newline delimited json,
+# one object per line, written out as rows come back from the database. nothing is built up in memory first, so the
+# first line goes out straight away and memory use stays the same however many rows there are
+
+# how many rows to fetch from the database at a time
+CHUNK_SIZE = 500
+
+
+def ndjson_response(query, serialize):
+    # query should ask for plain columns rather than whole models - with yield_per that keeps the session from
+    # holding on to every row it has seen
+    def generate():
+        for row in query.yield_per(CHUNK_SIZE):
+            yield dumps(serialize(row)) + b'\n'
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # tell nginx not to buffer the response, otherwise nothing arrives before the end
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def parse_since(value):
+    # ?since= takes the same iso 8601 times the stream hands out, eg 2020-05-17T10:02:34.532518Z
+    # returns None if it isn't one
+    value = value.rstrip('Z')
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    return None
@@ -1,8 +1,7 @@
-from flask import jsonify
-
 from app import db
 from app.api import bp
 from app.api.auth import basic_auth, token_auth
+from app.serializers import json_response
 
 
 @bp.route('/tokens', methods=['POST'])
@@ -11,7 +10,7 @@ def get_token():
     # this is the get_token function we implemented in User model
     token = basic_auth.current_user().get_token()
     db.session.commit() # we add the token in that function and only commit it here
-    return jsonify({'token': token})
+    return json_response({'token': token})
 
 @bp.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
@@ -1,48 +1,104 @@
-from flask import jsonify, request, url_for
+from flask import request, url_for
 
 from app import db
 from app.api import bp
 from app.api.auth import token_auth
-from app.api.errors import bad_request
-from app.models import User
+from app.api.batch import get_ids, batch_query, to_batch_dict
+from app.api.conditional import conditional, row_validator, collection_validator
+from app.api.errors import bad_request, error_response
+from app.api.fields import get_fieldset
+from app.api.streaming import ndjson_response, parse_since
+from app.models import User, Post, followers
+from app.serializers import json_response, isoformat, url
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
+@conditional(lambda id: row_validator(User, id))
 def get_user(id):
     # get_or_404 very useful method that returns either the id or 404 (instead of none) if it does not
     # if it does find it, it returns a User object, which we then use self.to_dict() on to convert to appropriate format
-    # jsonify is a MUST for the view function to work correctly (in browser or in terminal)
-    return jsonify(User.query.get_or_404(id).to_dict())
+    # json_response (our faster jsonify, see app/serializers.py) is a MUST for the view function to work correctly (in browser or in terminal)
+    return json_response(User.query.get_or_404(id).to_dict(fieldset=get_fieldset(User)))
+
+
+def users_validator():
+    ids = get_ids()
+    return collection_validator(User.query if ids is None else batch_query(User, ids), User)
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
+@conditional(users_validator)
 def get_users():
+    # ?ids=1,2,3 fetches just those users (see app/api/batch.py)
+    ids = get_ids()
+    if ids is not None:
+        return json_response(to_batch_dict(User, ids, get_fieldset(User)))
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100) #not more than 100
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users', fieldset=get_fieldset(User))
+    return json_response(data)
+
+
+def follow_list_validator(id, own_column, other_column):
+    if db.session.query(User.id).filter_by(id=id).first() is None:
+        return None
+    return collection_validator(User.query.join(followers, own_column == User.id).filter(other_column == id), User)
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
+@conditional(lambda id: follow_list_validator(id, followers.c.follower_id, followers.c.followed_id))
 def get_followers(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100) #not more than 100
-    data = User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', id=id)
-    return jsonify(data)
+    data = User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', fieldset=get_fieldset(User),
+                                   id=id)
+    return json_response(data)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
+@conditional(lambda id: follow_list_validator(id, followers.c.followed_id, followers.c.follower_id))
 def get_followed(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100) #not more than 100
-    data = User.to_collection_dict(user.followed, page, per_page, 'api.get_followed', id=id)
-    return jsonify(data)
+    data = User.to_collection_dict(user.followed, page, per_page, 'api.get_followed', fieldset=get_fieldset(User),
+                                   id=id)
+    return json_response(data)
+
+
+@bp.route('/users/<int:id>/posts.ndjson', methods=['GET'])
+@token_auth.login_required
+def get_user_posts_stream(id):
+    # all of a user's posts, oldest change first, as newline delimited json (see app/api/streaming.py)
+    # for incremental sync pass the updated_at of the last post you got as ?since= - posts changed at that very
+    # moment come again, so nothing is missed if several changed at once
+    if db.session.query(User.id).filter_by(id=id).first() is None:
+        return error_response(404)
+    query = db.session.query(Post.id, Post.body, Post.timestamp, Post.user_id, Post.language,
+                             Post.version, Post.updated_at).filter(Post.user_id == id)
+    if 'since' in request.args:
+        since = parse_since(request.args['since'])
+        if since is None:
+            return bad_request('since must be an iso 8601 time')
+        query = query.filter(Post.updated_at >= since)
+    query = query.order_by(Post.updated_at, Post.id)
+    return ndjson_response(query, lambda post: {
+        'id': post.id,
+        'body': post.body,
+        'timestamp': isoformat(post.timestamp),
+        'user_id': post.user_id,
+        'language': post.language,
+        'version': post.version,
+        'updated_at': isoformat(post.updated_at),
+        '_links': {
+            'self': url('api.get_post', post.id)
+        }
+    })
 
 
 @bp.route('/users', methods=['POST'])
@@ -70,7 +126,7 @@ def create_user():
     db.session.commit()
 
     # prepare the response with user's details and status 201
-    response = jsonify(user.to_dict())
+    response = json_response(user.to_dict())
     response.status_code = 201
     # status code 201 requires us to return the Location header that is set to the URL of the new resource
     response.headers['Location'] = url_for('api.get_user', id=user.id)
@@ -97,6 +153,6 @@ def update_user(id):
     # amend & update the db
     user.from_dict(data, new_user=False)
     db.session.commit()
-    return jsonify(user.to_dict())
+    return json_response(user.to_dict())
 
 
@@ -0,0 +1,202 @@
+# a small two-tier cache: a per-process LRU in front of redis. set up as app.cache in create_app
+#
+# every entry is stored with the tags it depends on (eg 'user:12'), and every tag has a version in redis. changing a
+# row bumps the versions of its tags once the transaction commits (see models.py), and any entry that was stored
+# under an older version is then treated as missing - so nothing has to know which keys to delete
+# the local tier skips the redis round trip entirely, at the price of seeing changes made by other processes
+# up to CACHE_LOCAL_TTL seconds late. changes made by this process are seen straight away
+#
+# CACHE_BACKEND = 'redis' uses both tiers, 'local' only the process-local one, 'null' turns caching off
+
+import functools
+import logging
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import redis
+from flask import current_app
+
+
+class _Flight(object):
+    # one computation of a missing key, which other threads asking for the same key wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.value = None
+
+
+class Cache(object):
+
+    def __init__(self, app):
+        self.backend = app.config['CACHE_BACKEND']
+        self.redis = app.redis if self.backend == 'redis' else None
+        self.timeout = app.config['CACHE_DEFAULT_TIMEOUT']
+        self.local_size = app.config['CACHE_LOCAL_SIZE']
+        self.local_ttl = app.config['CACHE_LOCAL_TTL']
+        self.lock = threading.Lock()
+        # key -> (expires, tag versions, value)
+        self.local = OrderedDict()
+        # tag -> version, for the tags this process has seen or bumped
+        self.local_tags = {}
+        self.flights = {}
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def tag_key(tag):
+        return 'cache:tag:{}'.format(tag)
+
+    def _local_get(self, key, tags):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is None:
+                return False, None
+            expires, versions, value = entry
+            if expires < time.time() or versions != tuple(self.local_tags.get(tag) for tag in tags):
+                del self.local[key]
+                return False, None
+            self.local.move_to_end(key)
+            return True, value
+
+    def _local_set(self, key, versions, value, timeout):
+        with self.lock:
+            self.local[key] = (time.time() + min(timeout, self.local_ttl), versions, value)
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def _count(self, hit):
+        # += isn't atomic, so the counters are only touched under the lock
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _remote_get(self, key, tags):
+        # the entry and the current versions of its tags in one round trip
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get('cache:' + key)
+        if tags:
+            pipe.mget([self.tag_key(tag) for tag in tags])
+        results = pipe.execute()
+        versions = tuple(v.decode() if v else None for v in results[1]) if tags else ()
+        with self.lock:
+            self.local_tags.update(zip(tags, versions))
+        if results[0] is not None:
+            stored_versions, value = pickle.loads(results[0])
+            if stored_versions == versions:
+                return True, versions, value
+        return False, versions, None
+
+    def get_or_set(self, key, compute, tags=(), timeout=None):
+        # returns the cached value for key, or calls compute() and caches what it returns
+        if self.backend == 'null':
+            return compute()
+        tags = tuple(tags)
+        timeout = timeout or self.timeout
+        found, value = self._local_get(key, tags)
+        if found:
+            self._count(True)
+            return value
+
+        # single flight: if another thread is already working this key out, wait for its answer instead
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.ok:
+                return flight.value
+            # the leader failed, have a go ourselves
+            return compute()
+
+        try:
+            versions = tuple(self.local_tags.get(tag) for tag in tags)
+            if self.redis is not None:
+                try:
+                    found, versions, value = self._remote_get(key, tags)
+                except redis.exceptions.RedisError:
+                    logging.debug('cache unavailable', exc_info=True)
+                    found = False
+            self._count(found)
+            if not found:
+                # the versions were read before computing, so a bump that happens meanwhile still invalidates this
+                value = compute()
+                if self.redis is not None:
+                    try:
+                        self.redis.set('cache:' + key, pickle.dumps((versions, value)), ex=timeout)
+                    except redis.exceptions.RedisError:
+                        logging.debug('cache unavailable', exc_info=True)
+            self._local_set(key, versions, value, timeout)
+            flight.value, flight.ok = value, True
+            return value
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def invalidate(self, *tags):
+        # gives each tag a new version, which makes every entry stored under the old one stale
+        if not tags:
+            return
+        versions = {tag: uuid.uuid4().hex for tag in tags}
+        with self.lock:
+            self.local_tags.update(versions)
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for tag, version in versions.items():
+                    # tags outlive the entries that depend on them, otherwise an expired tag could make a stale entry match again
+                    pipe.set(self.tag_key(tag), version, ex=2 * self.timeout)
+                pipe.execute()
+            except redis.exceptions.RedisError:
+                current_app.logger.error('could not invalidate cache tags %s', tags, exc_info=True)
+
+
+def memoize(key, tags=(), timeout=None):
+    # caches what the function returns. key and tags are format strings filled in with the function's arguments:
+    #   @memoize('user:{0.id}:followers', tags=['user:{0.id}'])
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            return current_app.cache.get_or_set(
+                key.format(*args, **kwargs), lambda: f(*args, **kwargs),
+                [tag.format(*args, **kwargs) for tag in tags], timeout)
+        return wrapper
+    return decorator
+
+
+def queue_tags(session, *tags):
+    # for changes the session doesn't see as objects (eg rows of the followers table)
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def collect_tags(session, flush_context):
+    # triggered after each flush. models can list extra tags they affect in a cache_tags() method
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        if hasattr(obj, 'cache_tags'):
+            tags = obj.cache_tags()
+        elif hasattr(obj, 'id'):
+            tags = ['{}:{}'.format(obj.__tablename__, obj.id)]
+        else:
+            continue
+        queue_tags(session, *tags)
+
+
+def bump_queued(session):
+    # triggered after each commit
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        current_app.cache.invalidate(*tags)
+
+
+def discard_queued(session, previous_transaction=None):
+    # triggered after a rollback
+    session.info.pop('cache_tags', None)
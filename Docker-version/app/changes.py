@@ -0,0 +1,119 @@
+# the change log behind /api/changes: one row per post, user or follow that was created, changed or deleted, in the
+# order the changes were committed. consumers keep the cursor (the id of the last change they saw) and ask for what
+# came after it, instead of paging through everything to spot differences
+#
+# changes are collected after each flush (when the session still knows what's new, dirty and deleted) and written
+# once the transaction commits, in a short transaction of their own - so rolled back changes never show up. a change
+# made without the session (eg Post.insert_many) calls queue() itself
+# waiting consumers (?wait=) are woken through redis pub/sub when new changes are written
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+import redis
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+
+CHANNEL = 'changes'
+
+
+def queue(session, type, action, object_id, related_id=None, version=None):
+    changes = session.info.setdefault('changes', {})
+    key = (type, object_id, related_id)
+    # one change per thing per transaction - if it was also created in it, it's still a create
+    if key in changes and changes[key]['action'] == 'create' and action == 'update':
+        action = 'create'
+    changes.pop(key, None)
+    changes[key] = {'type': type, 'action': action, 'object_id': object_id, 'related_id': related_id,
+                    'version': version}
+
+
+def collect(session, flush_context):
+    # triggered after each flush
+    from app.models import Post, User
+    for obj in session.new:
+        if isinstance(obj, (Post, User)):
+            queue(session, obj.__tablename__, 'create', obj.id, version=obj.version)
+    for obj in session.dirty:
+        # see VersionedMixin.unannounced
+        if isinstance(obj, (Post, User)) and obj.changed() and getattr(obj, '_announce', True):
+            queue(session, obj.__tablename__, 'update', obj.id, version=obj.version)
+    for obj in session.deleted:
+        if isinstance(obj, (Post, User)):
+            queue(session, obj.__tablename__, 'delete', obj.id, version=obj.version)
+
+
+def write_queued(session):
+    # triggered after each commit. the session's own transaction is over, so this uses a connection of its own
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+    from app.models import Change
+    now = datetime.utcnow()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(Change.__table__.insert(), [dict(change, timestamp=now) for change in changes.values()])
+    except SQLAlchemyError:
+        # the changes themselves are committed, but consumers of the log won't hear about them
+        current_app.logger.error('could not write to the change log', exc_info=True)
+        return
+    try:
+        current_app.redis.publish(CHANNEL, '')
+    except redis.exceptions.RedisError:
+        logging.debug('could not announce changes', exc_info=True)
+
+
+def discard_queued(session, previous_transaction=None):
+    # triggered after a rollback
+    session.info.pop('changes', None)
+
+
+def _settled(rows, since):
+    # ids are handed out before the insert commits, so a change can show up after one with a higher id. reading past
+    # a gap would skip it for good - so we stop there until the gap is CHANGE_LOG_SETTLE seconds old, by when
+    # whatever was going to fill it has (or was rolled back and never will)
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['CHANGE_LOG_SETTLE'])
+    settled = []
+    for row in rows:
+        if row.id != since + 1 and row.timestamp > cutoff:
+            break
+        settled.append(row)
+        since = row.id
+    return settled
+
+
+def read(since, limit, wait=0):
+    # up to `limit` changes after the cursor `since`. with `wait` and nothing new yet, waits up to that many seconds
+    # for something to happen (long polling)
+    from app.models import Change
+    deadline = time.time() + wait
+    pubsub = None
+    if wait:
+        try:
+            # subscribed before the first read, so nothing written in between is missed
+            pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+        except redis.exceptions.RedisError:
+            pubsub = None
+    try:
+        while True:
+            rows = _settled(Change.query.filter(Change.id > since).order_by(Change.id).limit(limit).all(), since)
+            remaining = deadline - time.time()
+            if rows or remaining <= 0:
+                return rows
+            # end the transaction, otherwise the next read could see the same snapshot of the table
+            db.session.rollback()
+            # wake up at least once a second, to check on gaps that are settling
+            if pubsub is not None:
+                try:
+                    pubsub.get_message(timeout=min(remaining, 1))
+                    continue
+                except redis.exceptions.RedisError:
+                    pubsub = None
+            time.sleep(min(remaining, 1))
+    finally:
+        if pubsub is not None:
+            pubsub.close()
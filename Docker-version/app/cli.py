@@ -1,5 +1,8 @@
 import os
 import click
+from rq.registry import ScheduledJobRegistry
+
+from app.worker import run_workers
 
 
 def register(app):
@@ -33,3 +36,45 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.command()
+    @click.option('--processes', '-n', default=2, show_default=True,
+                  help='Number of worker processes to run.')
+    @click.option('--queue', default='microblog-tasks', show_default=True,
+                  help='Queue to take jobs from.')
+    @click.option('--max-jobs', type=int, default=None,
+                  help='Restart a worker after it has run this many jobs.')
+    @click.option('--fork-after-import/--no-fork-after-import', default=True,
+                  show_default=True,
+                  help='Build the app once and fork the workers from it, '
+                       'instead of building it in every worker.')
+    @click.option('--with-scheduler', is_flag=True,
+                  help='Also run the scheduler for delayed jobs (eg digests).')
+    def worker(processes, queue, max_jobs, fork_after_import, with_scheduler):
+        """Run a pool of background task workers."""
+        run_workers(processes, queue_name=queue, max_jobs=max_jobs,
+                    fork_after_import=fork_after_import,
+                    with_scheduler=with_scheduler)
+
+    @app.cli.group()
+    def digest():
+        """Follower and message digest emails."""
+        pass
+
+    @digest.command()
+    def run():
+        """Send the digest emails now, without scheduling the next run."""
+        # imported here because app.tasks builds its own app when it's imported outside of one
+        from app.tasks import send_digests
+        send_digests(reschedule=False)
+
+    @digest.command()
+    def schedule():
+        """Queue the recurring digest job (needs a worker --with-scheduler)."""
+        registry = ScheduledJobRegistry(queue=app.task_queue)
+        job_ids = registry.get_job_ids() + app.task_queue.get_job_ids()
+        for job_id in job_ids:
+            job = app.task_queue.fetch_job(job_id)
+            if job and job.func_name == 'app.tasks.send_digests':
+                raise click.ClickException('the digest job is already scheduled')
+        app.task_queue.enqueue('app.tasks.send_digests')
@@ -1,13 +1,161 @@
-from threading import Thread
+import logging
+import queue
+import smtplib
+import threading
+import time
+
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
 # the email doc got split into two email docs: this one and one in auth
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# outgoing mail is put on a bounded queue (app.mail_queue, set up in create_app) instead of getting a thread each.
+# a few sender threads take messages off in batches and push each batch through a single smtp connection.
+# to try it locally, run a debugging smtp server (eg `python -m aiosmtpd -n -l localhost:8025`)
+# and start the app with MAIL_SERVER=localhost MAIL_PORT=8025
+
+
+def _is_transient(error):
+    # worth another try: dropped/refused connections, timeouts and 4xx replies. anything else (eg a 5xx for a bad address) isn't
+    # the order matters - smtplib's exceptions are all OSErrors too, so they have to be sorted out before the OSError catch-all
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # the server won't take this message's recipients - sending it again won't change that
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+def deliver(messages, stats=None):
+    # sends all messages over one smtp connection, retrying the ones hit by transient errors with a growing delay
+    # needs an app context. returns the messages that couldn't be delivered
+    pending = list(messages)
+    retries = current_app.config['MAIL_MAX_RETRIES']
+    # messages that failed for good, over all the attempts
+    failed = []
+    for attempt in range(retries + 1):
+        try:
+            with mail.connect() as conn:
+                while pending:
+                    msg = pending[0]
+                    try:
+                        conn.send(msg)
+                    except Exception as e:
+                        if _is_transient(e):
+                            raise
+                        current_app.logger.error('Could not send email to %s', msg.recipients, exc_info=True)
+                        failed.append(msg)
+                    else:
+                        if stats is not None:
+                            stats.record(msg)
+                    pending.pop(0)
+        except Exception as e:
+            if not _is_transient(e):
+                raise
+            logging.warning('transient smtp error (attempt %d): %s', attempt + 1, e)
+            if stats is not None:
+                stats.record_retry()
+        if not pending:
+            return failed
+        if attempt < retries:
+            time.sleep(current_app.config['MAIL_RETRY_DELAY'] * 2 ** attempt)
+    current_app.logger.error('Giving up on %d emails after %d attempts', len(pending), retries + 1)
+    return failed + pending
+
+
+class MailStats(object):
+    # delivery counters, and how long messages waited between send_email() and the smtp server taking them
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, msg):
+        latency = time.time() - getattr(msg, 'queued_at', time.time())
+        with self.lock:
+            self.sent += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_failures(self, count):
+        with self.lock:
+            self.failed += count
+
+    def as_dict(self):
+        with self.lock:
+            return {'sent': self.sent, 'retries': self.retries, 'failed': self.failed,
+                    'avg_latency': self.total_latency / self.sent if self.sent else 0.0,
+                    'max_latency': self.max_latency}
+
+
+class MailQueue(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.stats = MailStats()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # threads are only started when the first email goes out, so processes that never send mail never get them
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.app.config['MAIL_WORKERS']):
+                t = threading.Thread(target=self._run, name='mail-sender-{}'.format(i), daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def put(self, msg):
+        # when the queue is full the caller waits for room (backpressure) - but not forever
+        self._start()
+        msg.queued_at = time.time()
+        try:
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.app.logger.error('Mail queue full, dropping email to %s', msg.recipients)
+            self.stats.record_failures(1)
+            return False
+        return True
+
+    def join(self):
+        # waits until everything queued so far has been dealt with
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # grab whatever else is already waiting, so it all goes through the same connection
+            while len(batch) < self.app.config['MAIL_BATCH_SIZE']:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    failed = deliver(batch, self.stats)
+                self.stats.record_failures(len(failed))
+                logging.debug('mail batch of %d done, stats: %s', len(batch), self.stats.as_dict())
+            except Exception:
+                self.stats.record_failures(len(batch))
+                self.app.logger.error('Unhandled exception sending email', exc_info=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
 
 
 def send_email(subject, sender, recipients, text_body, html_body,
@@ -21,5 +169,4 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_async_email,
-            args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+        current_app.mail_queue.put(msg)
@@ -1,7 +1,8 @@
-from flask import render_template, request
+from flask import render_template, request, current_app
 from app import db
 from app.errors import bp
 from app.api.errors import error_response as api_error_response
+from app.passwords import PasswordHashingBusy
 
 # checks what type of response the client prefers
 def wants_json_response():
@@ -24,3 +25,15 @@ def internal_error(error):
     if wants_json_response():
         return api_error_response(404)
     return render_template('errors/500.html'), 500
+
+
+@bp.app_errorhandler(PasswordHashingBusy)
+def password_hashing_busy(error):
+    # too many logins at once - tell the client to try again shortly rather than making everyone wait
+    if wants_json_response():
+        response = api_error_response(503, 'too many logins at once, please retry')
+    else:
+        response = render_template('errors/503.html'), 503
+    response = current_app.make_response(response)
+    response.headers['Retry-After'] = '1'
+    return response
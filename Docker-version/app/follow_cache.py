@@ -0,0 +1,152 @@
+# caches who each user follows, as a set of followed user ids, so is_following() (called on every profile page and
+# popup) doesn't need a query each time. set up as app.follow_cache in create_app
+# FOLLOW_CACHE_BACKEND picks where the sets live: 'redis' (the default) shares them between all processes, 'local' keeps
+# them in this process only - only fine with a single server process. either way entries expire after FOLLOW_CACHE_TTL seconds
+# follow() and unfollow() queue their change, and it's applied to the cache once the transaction commits
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from flask import current_app
+
+
+class LocalFollowCache(object):
+    # least recently used sets are thrown out once there are more than `size` of them
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            expires, ids = entry
+            if expires < time.time():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return set(ids)
+
+    def set(self, user_id, ids):
+        with self.lock:
+            self.entries[user_id] = (time.time() + self.ttl, frozenset(ids))
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def apply(self, changes):
+        # only sets we already hold are updated - a missing one gets loaded from the db next time anyway
+        with self.lock:
+            for follower_id, followed_id, following in changes:
+                entry = self.entries.get(follower_id)
+                if entry is None:
+                    continue
+                expires, ids = entry
+                ids = ids | {followed_id} if following else ids - {followed_id}
+                self.entries[follower_id] = (expires, ids)
+
+
+# adds or removes one id, but only if the set is already cached. otherwise we'd be creating a set with just that id in it
+REDIS_APPLY_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    if ARGV[2] == '1' then
+        redis.call('sadd', KEYS[1], ARGV[1])
+    else
+        redis.call('srem', KEYS[1], ARGV[1])
+    end
+end
+"""
+
+
+class RedisFollowCache(object):
+    # redis doesn't keep empty sets around, so every cached set also holds this marker - that way a user who
+    # follows nobody is still a cache hit
+    EMPTY = '-'
+
+    def __init__(self, connection, ttl):
+        self.redis = connection
+        self.ttl = ttl
+        self.apply_script = connection.register_script(REDIS_APPLY_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return 'following:{}'.format(user_id)
+
+    def get(self, user_id):
+        members = self.redis.smembers(self.key(user_id))
+        if not members:
+            return None
+        return {int(m) for m in members if m != self.EMPTY.encode()}
+
+    def set(self, user_id, ids):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key(user_id))
+        pipe.sadd(self.key(user_id), self.EMPTY, *ids)
+        pipe.expire(self.key(user_id), self.ttl)
+        pipe.execute()
+
+    def apply(self, changes):
+        pipe = self.redis.pipeline()
+        for follower_id, followed_id, following in changes:
+            self.apply_script(keys=[self.key(follower_id)], args=[followed_id, int(following)], client=pipe)
+        pipe.execute()
+
+
+def make_follow_cache(app):
+    if app.config['FOLLOW_CACHE_BACKEND'] == 'local':
+        return LocalFollowCache(app.config['FOLLOW_CACHE_SIZE'], app.config['FOLLOW_CACHE_TTL'])
+    return RedisFollowCache(app.redis, app.config['FOLLOW_CACHE_TTL'])
+
+
+def queue_change(session, follower_id, followed_id, following):
+    session.info.setdefault('follow_changes', []).append((follower_id, followed_id, following))
+
+
+def followed_ids(session, user_id, load):
+    # `load` reads the ids from the db on a cache miss
+    # changes made in this transaction aren't in the cache yet, so they're laid on top of whatever it returned
+    pending = [change for change in session.info.get('follow_changes', []) if change[0] == user_id]
+    cache = current_app.follow_cache
+    try:
+        ids = cache.get(user_id)
+    except redis.exceptions.RedisError:
+        logging.debug('follow cache unavailable', exc_info=True)
+        cache, ids = None, None
+    if ids is None:
+        ids = load()
+        # what the db shows us includes our own uncommitted changes, which mustn't end up in the cache
+        if cache is not None and not pending:
+            try:
+                cache.set(user_id, ids)
+            except redis.exceptions.RedisError:
+                logging.debug('follow cache unavailable', exc_info=True)
+    for follower_id, followed_id, following in pending:
+        if following:
+            ids.add(followed_id)
+        else:
+            ids.discard(followed_id)
+    return ids
+
+
+def apply_queued(session):
+    # triggered after each commit (see models.py)
+    changes = session.info.pop('follow_changes', None)
+    if not changes:
+        return
+    try:
+        current_app.follow_cache.apply(changes)
+    except redis.exceptions.RedisError:
+        # the stale sets expire after FOLLOW_CACHE_TTL, so it's not the end of the world
+        logging.warning('could not update the follow cache', exc_info=True)
+
+
+def discard_queued(session, previous_transaction=None):
+    # triggered after a rollback
+    session.info.pop('follow_changes', None)
@@ -1,14 +1,23 @@
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
+from hashlib import sha1
+from time import time
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app, send_file, render_template_string
+    jsonify, current_app, send_file, render_template_string, abort, Response, Markup, \
+    make_response, session
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
+from flask_wtf.csrf import generate_csrf
 from guess_language import guess_language
+from redis.exceptions import RedisError
 from rq.job import Job, cancel_job
 
 from app import db
+from app.notifications import channel as notification_channel, \
+    stream as notification_events
 from app.auth.forms import MessageForm
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Message, Task
+from app.timeline import followed_posts_page
 from app.translate import translate
 
 from app.main import bp
@@ -19,8 +28,12 @@ from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, \
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # only written every so often - every write is a commit, and it changes the user's cached pages too
+        now = datetime.utcnow()
+        if current_user.last_seen is None or now - current_user.last_seen > \
+                timedelta(seconds=current_app.config['LAST_SEEN_INTERVAL']):
+            current_user.last_seen = now
+            db.session.commit()
         # we instantiate the form and associate it with the g container provided by flask, so that the form persists on the page
         # This g variable provided by Flask is a place where the application can store data that needs to persist through the life of a request.
         # it's important to note that g variable is specific to each request and each client - so even if the server is handling many requests for many clients, the info is containerised privately
@@ -46,14 +59,19 @@ def index():
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    # with TIMELINE_MODE = 'hybrid' the first pages come from redis (see app/timeline.py), the rest from the db
+    posts = followed_posts_page(current_user, page, current_app.config['POSTS_PER_PAGE'])
+    if posts is None:
+        posts = current_user.followed_posts().paginate(
+            page, current_app.config['POSTS_PER_PAGE'], False)
+        posts = posts.items, posts.has_next
+    posts, has_next = posts
+    next_url = url_for('main.index', page=page + 1) \
+        if has_next else None
+    prev_url = url_for('main.index', page=page - 1) \
+        if page > 1 else None
     return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -61,17 +79,25 @@ def index():
 @login_required
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    # the list of posts is the same for everyone, so it's rendered once per page and language and cached until
+    # a post is added or changed (the 'posts' tag, see app/cache.py). the rest of the page is still rendered per request
+    posts_html, has_next = current_app.cache.get_or_set(
+        'explore:{}:{}'.format(g.locale, page), lambda: _render_explore_posts(page), tags=['posts'])
+    next_url = url_for('main.explore', page=page + 1) \
+        if has_next else None
+    prev_url = url_for('main.explore', page=page - 1) \
+        if page > 1 else None
     return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
+                           posts_html=Markup(posts_html), next_url=next_url,
                            prev_url=prev_url)
 
 
+def _render_explore_posts(page):
+    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
+        page, current_app.config['POSTS_PER_PAGE'], False)
+    return str(render_template('_posts.html', posts=posts.items)), posts.has_next
+
+
 @bp.route('/user/<username>')
 @login_required
 def user(username):
@@ -180,23 +206,38 @@ def user_search():
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.user_search', q=g.user_search_form.q.data, page=page - 1) \
         if page > 1 else None
+    # follow state for the whole page in one lookup, instead of an is_following() per user
+    following = current_user.is_following_many([user.id for user in users])
     return render_template('user_search.html', title=_('User Search'), users=users,
-                           next_url=next_url, prev_url=prev_url)
+                           following=following, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/export_posts')
 @login_required
 def export_posts():
-    # if current_user.get_task_in_progress('export_posts'):
-    #     flash('an export in progress')
-    # else:
-    # for i in range(50):
-    current_user.launch_task('export_posts', 'exporting posts...')
+    # launch_task hands back the export that is already queued if there is one, so clicking again doesn't stack up jobs
+    if current_user.launch_task('export_posts', 'exporting posts...') is None:
+        flash(_('Too many background tasks are running, please try again later.'))
+    else:
+        flash(_('Your posts are being exported.'))
     db.session.commit()
     return redirect(url_for('main.index'))
     # return redirect(url_for('main.display_posts', id=job.id))
 
 
+# streams a finished export back to its owner
+# send_file with conditional=True sets Content-Length and answers Range requests, so big downloads can be resumed
+@bp.route('/export_posts/<id>/download')
+@login_required
+def download_export(id):
+    task = Task.query.filter_by(id=id, user=current_user).first_or_404()
+    if not task.artifact_path or not os.path.exists(task.artifact_path):
+        abort(404)
+    return send_file(task.artifact_path, mimetype='application/gzip',
+                     as_attachment=True, attachment_filename='posts.jsonl.gz',
+                     conditional=True)
+
+
 # this displays the results back to the user!
 @bp.route('/display_posts/<id>')
 def display_posts(id):
@@ -224,16 +265,59 @@ def cancel_export():
             if not task.complete:
                 job = Job.fetch(task.id, connection=current_app.redis)
                 job.cancel()
+                if 'slot_keys' in job.meta:
+                    Task.release_slot(current_app.redis, job.meta['slot_keys'], job.get_id())
     print('all jobs cancelled')
     return redirect(url_for('main.index'))
 
 
+# stands in for the csrf token in cached popups - the real token belongs to one session and is put back in per request
+CSRF_PLACEHOLDER = '__csrf_token__'
+
+
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    form = EmptyForm()
-    return render_template('user_popup.html', user=user, form=form)
+    # popups show up on every hover, so everything here comes from the cache (see app/cache.py) when it can:
+    # the user's id, the follow state (follow cache) and the rendered html
+    user_id = current_app.cache.get_or_set(
+        'user_id:' + username, lambda: _user_id(username), tags=['username:' + username])
+    if user_id is None:
+        abort(404)
+    if user_id == current_user.id:
+        state = 'self'
+    else:
+        state = 'following' if current_user.is_following_many([user_id]) else 'other'
+    html, digest = current_app.cache.get_or_set(
+        'user_popup:{}:{}:{}'.format(user_id, state, g.locale),
+        lambda: _render_user_popup(user_id), tags=['user:{}'.format(user_id)])
+
+    # the token in the page has to keep working, so the etag also changes with the session's csrf token,
+    # and at least every half of the time the token is valid for
+    token = generate_csrf()
+    period = int(time() // ((current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) / 2))
+    etag = sha1('{}:{}:{}'.format(digest, session.get('csrf_token'), period).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(html.replace(CSRF_PLACEHOLDER, token))
+    response.set_etag(etag)
+    # the browser may keep it, but has to check with us before using it again
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _user_id(username):
+    user = User.query.filter_by(username=username).first()
+    return user.id if user else None
+
+
+def _render_user_popup(user_id):
+    user = User.query.get(user_id)
+    html = render_template('user_popup.html', user=user, form=EmptyForm())
+    html = html.replace(generate_csrf(), CSRF_PLACEHOLDER)
+    return html, sha1(html.encode()).hexdigest()
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -252,6 +336,22 @@ def send_message(recipient):
     return render_template('send_message.html', title='send message', form=form, recipient=recipient)
 
 
+@bp.route('/broadcast', methods=['GET', 'POST'])
+@login_required
+def broadcast():
+    form = MessageForm()
+    if form.validate_on_submit():
+        # writing a message per follower can take a while, so it's done by a background task
+        if current_user.launch_task('broadcast_message', 'sending message to your followers...',
+                                    form.message.data) is None:
+            flash(_('Too many background tasks are running, please try again later.'))
+        else:
+            flash(_('Your message is being sent to your followers.'))
+        db.session.commit()
+        return redirect(url_for('main.user', username=current_user.username))
+    return render_template('broadcast.html', title=_('Message your followers'), form=form)
+
+
 @bp.route('/messages')
 @login_required
 def messages():
@@ -270,14 +370,49 @@ def messages():
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    messages, has_older, has_newer = Message.conversation_page(
+        Message.conversation_key(current_user.id, user.id),
+        current_app.config['POSTS_PER_PAGE'],
+        before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.conversation', username=user.username,
+                       before=messages[-1].cursor()) \
+        if messages and has_older else None
+    prev_url = url_for('main.conversation', username=user.username,
+                       after=messages[0].cursor()) \
+        if messages and has_newer else None
+    return render_template('conversation.html', user=user, messages=messages,
+                           next_url=next_url, prev_url=prev_url)
+
+
+# polling version, used by browsers that can't do server-sent events
 @bp.route('/notifications')
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
\ No newline at end of file
+    return jsonify(current_user.get_notifications(since))
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    # the browser sends Last-Event-ID by itself when it reconnects, so it gets exactly what it missed
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(notification_channel(current_user.id))
+    except RedisError:
+        # 204 tells EventSource to stop reconnecting, and the page falls back to polling
+        return '', 204
+    # everything the generator needs is worked out here, so it doesn't touch the db (or the request) while it streams
+    missed = current_user.get_notifications(since)
+    db.session.remove()
+    return Response(notification_events(
+        pubsub, missed, current_app.config['NOTIFICATION_HEARTBEAT'],
+        current_app.config['NOTIFICATION_STREAM_TIMEOUT']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
\ No newline at end of file
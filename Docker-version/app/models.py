@@ -3,8 +3,9 @@ import json
 import logging
 import os
 import traceback
+import uuid
 from datetime import datetime, timedelta
-from hashlib import md5
+from hashlib import md5, sha1
 from time import time
 
 import redis
@@ -12,9 +13,11 @@ import rq
 from flask import current_app, url_for
 from flask_login import UserMixin, current_user
 from guess_language import guess_language
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm.attributes import flag_modified
 import jwt
-from app import db, login
+from app import cache, changes, db, follow_cache, login, notifications, passwords, timeline, token_cache
+from app.serializers import ALL, isoformat, url
+from app.cache import memoize
 
 # pretty much didn't change except for references to current_app
 from app.search import query_index, add_to_index, remove_from_index
@@ -26,8 +29,13 @@ logging.basicConfig(filename='rq.log', level=logging.DEBUG,
 
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    # the primary key doubles as the index for "who does X follow" (followed_posts, is_following) and stops duplicate follows
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    # when the follow happened, so the digest job can pick up new followers without rescanning the whole table
+    db.Column('timestamp', db.DateTime, index=True, default=datetime.utcnow),
+    # and this one is for the other direction - "who follows X"
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 
@@ -81,17 +89,34 @@ class SearchableMixin(object):
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_commit', notifications.publish_queued)
+db.event.listen(db.session, 'after_soft_rollback', notifications.discard_queued)
+db.event.listen(db.session, 'after_commit', follow_cache.apply_queued)
+db.event.listen(db.session, 'after_soft_rollback', follow_cache.discard_queued)
+db.event.listen(db.session, 'after_flush', timeline.collect_posts)
+db.event.listen(db.session, 'after_commit', timeline.publish_queued)
+db.event.listen(db.session, 'after_soft_rollback', timeline.discard_queued)
+db.event.listen(db.session, 'after_flush', cache.collect_tags)
+db.event.listen(db.session, 'after_commit', cache.bump_queued)
+db.event.listen(db.session, 'after_soft_rollback', cache.discard_queued)
+db.event.listen(db.session, 'after_commit', token_cache.invalidate_queued)
+db.event.listen(db.session, 'after_soft_rollback', token_cache.discard_queued)
+db.event.listen(db.session, 'after_flush', changes.collect)
+db.event.listen(db.session, 'after_commit', changes.write_queued)
+db.event.listen(db.session, 'after_soft_rollback', changes.discard_queued)
 
 
 class PaginatedAPIMixin(object):
     # implementing this as a mixin to preserve generality so that we can apply it to other models afterwards
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, fieldset=ALL, **kwargs):
         # the first 3 arguments are a flask sql alchemy query
         # returns a pagination object with items for a given page
         resources = query.paginate(page, per_page, False)
+        # the links keep asking for the same fields
+        kwargs.update(fieldset.args)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.to_dicts(resources.items, fieldset),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -107,8 +132,60 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    # models can override this to fetch whatever their representations need for a whole page at once
+    @classmethod
+    def to_dicts(cls, items, fieldset=ALL):
+        return [item.to_dict(fieldset=fieldset) for item in items]
+
+
+class VersionedMixin(object):
+    # version goes up by one every time the row changes (see bump_versions below), and updated_at says when.
+    # together they let the api answer "has this changed?" without building the response (see app/api/conditional.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
+    # columns the api doesn't show, so changing them doesn't make a new version
+    unversioned = ()
+    # columns that do make a new version, but change too often to get an entry in the change log on their own
+    unannounced = ()
+
+    # for changes that show up in the api representation without changing the row itself (eg counters)
+    def touch(self):
+        # flag_modified needs the attribute loaded, which it isn't after a commit
+        self.version
+        flag_modified(self, 'version')
+
+    def changed(self, ignore=()):
+        state = db.inspect(self)
+        return any(state.attrs[column.key].history.has_changes()
+                   for column in state.mapper.column_attrs
+                   if column.key not in self.unversioned and column.key not in ignore)
+
+    @staticmethod
+    def bump_versions(session, flush_context, instances):
+        # triggered before each flush
+        now = datetime.utcnow()
+        with session.no_autoflush:
+            for obj in session.new:
+                # a new post changes its author's post count
+                if isinstance(obj, Post):
+                    author = obj.author or (User.query.get(obj.user_id) if obj.user_id else None)
+                    if author is not None and author not in session.new:
+                        author.touch()
+            for obj in session.dirty:
+                if isinstance(obj, VersionedMixin) and obj.changed():
+                    # for changes.collect() after the flush, when the new version would count as a change by itself
+                    obj._announce = obj.changed(ignore=obj.unannounced)
+                    obj.version = (obj.version or 0) + 1
+                    obj.updated_at = now
+
+db.event.listen(db.session, 'before_flush', VersionedMixin.bump_versions)
+
+
+class User(VersionedMixin, PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
+    unversioned = ('password_hash', 'token', 'token_expiration', 'last_message_read_time')
+    # last_seen is written every LAST_SEEN_INTERVAL while a user is active
+    unannounced = ('last_seen',)
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
@@ -151,11 +228,13 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
 
     def add_notification(self, name, data):
-        # if a notification with a similar name already exists - we delete it first
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        # replaces any earlier notification with the same name, and gets pushed to the user's open browser tabs once we commit
+        # where it's stored depends on NOTIFICATION_BACKEND, see app/notifications.py
+        return notifications.get_store().add(db.session, self, name, data)
+
+    # returns the notifications newer than `since` as name/data/timestamp dicts, oldest first
+    def get_notifications(self, since=0.0):
+        return notifications.get_store().since(self, since)
 
     # ---------------------------------------------------------------------------
 
@@ -163,10 +242,15 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
+    # on success, a hash made with old settings is replaced - the caller commits it
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not passwords.check_password(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def avatar(self, size):
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -174,16 +258,77 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
             digest, size)
 
     def follow(self, user):
-        if not self.is_following(user):
+        if not self.follows_in_db(user):
             self.followed.append(user)
+            # both users' counters change
+            self.touch()
+            user.touch()
+            follow_cache.queue_change(db.session, self.id, user.id, True)
+            changes.queue(db.session, 'follow', 'create', self.id, user.id)
+            timeline.queue_reset(db.session, self.id)
+            cache.queue_tags(db.session, 'user:{}'.format(self.id), 'user:{}'.format(user.id))
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self.follows_in_db(user):
             self.followed.remove(user)
+            self.touch()
+            user.touch()
+            follow_cache.queue_change(db.session, self.id, user.id, False)
+            changes.queue(db.session, 'follow', 'delete', self.id, user.id)
+            timeline.queue_reset(db.session, self.id)
+            cache.queue_tags(db.session, 'user:{}'.format(self.id), 'user:{}'.format(user.id))
+
+    # follow() and unfollow() ask the db rather than the follow cache before writing. a stale cache entry (the 'local'
+    # backend is per process) would otherwise add a row that's already there or delete one that isn't
+    def follows_in_db(self, user):
+        if self.id is None or user.id is None:
+            # not saved yet - flushing gives them ids to look up
+            db.session.flush()
+        return db.session.query(followers.c.follower_id).filter(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id).first() is not None
+
+    # the ids of everyone this user follows, from the follow cache (see follow_cache.py) when it has them
+    def followed_ids(self):
+        if self.id is None:
+            # not saved yet, so can't be following anyone
+            return set()
+        return follow_cache.followed_ids(db.session, self.id, lambda: {
+            id for id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id)})
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        followed = self.followed_ids()
+        return user.id in followed
+
+    # which of the given user ids this user follows - one cache lookup for a whole page of users
+    def is_following_many(self, ids):
+        followed = self.followed_ids()
+        return {id for id in ids if id in followed}
+
+    # the username and avatar (from the email) show up in cached lists of posts too
+    def cache_tags(self):
+        tags = ['user:{}'.format(self.id)]
+        state = db.inspect(self)
+        if state.attrs.username.history.has_changes() or state.attrs.email.history.has_changes():
+            tags.append('posts')
+        # the username -> id lookup of the user popup, for both the old and the new name
+        history = state.attrs.username.history
+        tags.extend('username:{}'.format(name) for name in list(history.added) + list(history.deleted) if name)
+        return tags
+
+    # counters for profiles, popups and the api. cached until something about the user changes (see cache.py)
+    @memoize('user:{0.id}:post_count', tags=['user:{0.id}'])
+    def post_count(self):
+        return self.posts.count()
+
+    @memoize('user:{0.id}:follower_count', tags=['user:{0.id}'])
+    def follower_count(self):
+        return self.followers.count()
+
+    @memoize('user:{0.id}:followed_count', tags=['user:{0.id}'])
+    def followed_count(self):
+        return self.followed.count()
 
     def followed_posts(self):
         followed = Post.query.join(
@@ -217,7 +362,37 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
     def launch_task(self, name, description, *args, **kwargs):
         # the "name" argument is the function name, as defined in app/tasks.py
         # the args/kwargs are positional arguments needed for the "name" function to actually run
-        rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id, *args, **kwargs)
+        # the same (user, name, args) can only be queued once at a time - asking again returns the job that's already there
+        # returns None if the user or this task type is already running as many tasks as the config allows
+        keys = Task.slot_keys(self.id, name, args, kwargs)
+        job_id = str(uuid.uuid4())
+        reserve = current_app.redis.register_script(TASK_RESERVE_SCRIPT)
+        for attempt in range(2):
+            now = time()
+            status, value = reserve(keys=keys, args=[
+                job_id, now, now + current_app.config['TASK_DEDUP_TTL'],
+                current_app.config['TASK_DEDUP_TTL'],
+                current_app.config['MAX_TASKS_PER_USER'],
+                current_app.config['MAX_TASKS_PER_TYPE']])
+            if status == b'limited':
+                return None
+            if status == b'reserved':
+                break
+            # somebody already queued this exact task - hand back their job, unless it's dead and left its key behind
+            existing = Task(id=value.decode('utf-8')).get_rq_job()
+            if existing is not None and existing.get_status() not in ('finished', 'failed', 'canceled', 'stopped'):
+                return existing
+            Task.release_slot(current_app.redis, keys, value.decode('utf-8'))
+        else:
+            return None
+
+        try:
+            rq_job = current_app.task_queue.enqueue_call(
+                'app.tasks.' + name, args=(self.id,) + args, kwargs=kwargs,
+                job_id=job_id, meta={'slot_keys': keys})
+        except redis.exceptions.RedisError:
+            Task.release_slot(current_app.redis, keys, job_id)
+            raise
         # this is where we're writing to the database
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(task) #note how we're adding the task, but not issuing the commit. This is because it's better to use higher level functions that group together actions of many lower level child functions like this one, when writing to the db.
@@ -231,31 +406,65 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
     def get_task_in_progress(self, name):
         return Task.query.filter_by(name=name, user=self, complete=False).first()
 
+    # returns the most recent finished task that left a file behind (eg an export)
+    def get_completed_task(self, name):
+        return Task.query.filter_by(name=name, user=self, complete=True).filter(
+            Task.artifact_path != None).order_by(Task.timestamp.desc()).first()
+
     # --------------------------------------------------------------------------
     # api stuff
-    def to_dict(self, include_email=False):
+    # what the api can return for a user (clients can pick with ?fields=). the counters are the expensive bit
+    api_fields = ['id', 'username', 'last_seen', 'about_me', 'post_count', 'follower_count', 'followed_count', '_links']
+    api_counters = ['post_count', 'follower_count', 'followed_count']
+    api_expansions = {}
+
+    def to_dict(self, include_email=False, fieldset=ALL, counts=None):
         # define the representation structure we're going to be using in the api
-        # then pull the required fields from the db
+        # then pull the required fields from the db - only the ones asked for
         # email is optional because we will only be showing it when request comes from account owner, otherwise we don't want to reveal it
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z',
-            'about_me': self.about_me,
-            'post_count': self.posts.count(), #example of where representation in api doesn't match that in db
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'followed': url_for('api.get_followed', id=self.id),
-                'avatar': self.avatar(128)
-            }
-        }
+        # counts can be passed in when they've been worked out for a whole page (see to_dicts), otherwise they come
+        # from the cached counters
+        data = {}
+        for field in fieldset.select(User.api_fields):
+            if field in User.api_counters:
+                #example of where representation in api doesn't match that in db
+                data[field] = counts[field] if counts is not None else getattr(self, field)()
+            elif field == 'last_seen':
+                data[field] = isoformat(self.last_seen)
+            elif field == '_links':
+                data[field] = {
+                    'self': url('api.get_user', self.id),
+                    'followers': url('api.get_followers', self.id),
+                    'followed': url('api.get_followed', self.id),
+                    'avatar': self.avatar(128)
+                }
+            else:
+                data[field] = getattr(self, field)
         if include_email:
             data['email'] = self.email
         return data
 
+    @classmethod
+    def to_dicts(cls, items, fieldset=ALL):
+        # a page of users gets its counters with one grouped query each instead of three per user
+        counters = fieldset.select(User.api_counters)
+        if len(items) < 2 or not counters:
+            return [item.to_dict(fieldset=fieldset) for item in items]
+        ids = [item.id for item in items]
+        counts = {id: dict.fromkeys(counters, 0) for id in ids}
+        queries = {
+            'post_count': db.session.query(Post.user_id, db.func.count(Post.id)).filter(
+                Post.user_id.in_(ids)).group_by(Post.user_id),
+            'follower_count': db.session.query(followers.c.followed_id, db.func.count()).filter(
+                followers.c.followed_id.in_(ids)).group_by(followers.c.followed_id),
+            'followed_count': db.session.query(followers.c.follower_id, db.func.count()).filter(
+                followers.c.follower_id.in_(ids)).group_by(followers.c.follower_id),
+        }
+        for counter in counters:
+            for id, count in queries[counter]:
+                counts[id][counter] = count
+        return [item.to_dict(fieldset=fieldset, counts=counts[item.id]) for item in items]
+
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
             if field in data:
@@ -272,6 +481,7 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
             return self.token
 
         # else let's create a new one
+        token_cache.queue_invalidation(db.session, self.token)
         self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -280,6 +490,7 @@ class User(PaginatedAPIMixin, SearchableMixin, UserMixin, db.Model):
     def revoke_token(self):
         # set expiration to be 1 second before right now, so it won't pass the below test
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        token_cache.queue_invalidation(db.session, self.token)
 
     @staticmethod
     def check_token(token):
@@ -294,38 +505,78 @@ def load_user(id):
     return User.query.get(int(id))
 
 
-class Post(PaginatedAPIMixin, SearchableMixin, db.Model):
+class Post(VersionedMixin, PaginatedAPIMixin, SearchableMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
 
+    # a user's posts newest first (profile page, followed_posts) straight from the index
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    # a new or changed post also changes its author's post count, and the cached explore pages
+    def cache_tags(self):
+        return ['post:{}'.format(self.id), 'user:{}'.format(self.user_id), 'posts']
+
     # we're saying that this model (Post) needs to have its body indexed for searching
     __searchable__ = ['body']
 
     # --------------------------------------------------------------------------
     # api stuff
-    def to_dict(self):
-        data = {
-            'id': self.id,
-            'body': self.body,
-            'timestamp': self.timestamp,
-            'user_id': self.user_id,
-            'language': self.language,
-            '_links': {
-                'self': url_for('api.get_post', id=self.id)
-            }
-        }
-        if self.id-1 > 0:
-            data['_links']['previous'] = url_for('api.get_post', id=self.id-1)
-        if self.id+1 in [p.id for p in Post.query.all()]:
-            data['_links']['next'] = url_for('api.get_post', id=self.id+1)
+    # what the api can return for a post (?fields=), and what it can include along with it (?expand=)
+    api_fields = ['id', 'body', 'timestamp', 'user_id', 'language', '_links']
+    api_expansions = {'author': User}
+
+    def to_dict(self, fieldset=ALL, has_next=None, author=None):
+        # previous/next link to the posts with the ids either side. has_next can be passed in when it's already known
+        # (see to_dicts), otherwise it takes a query. the same goes for the expanded author
+        data = {}
+        for field in fieldset.select(Post.api_fields):
+            if field == 'timestamp':
+                data[field] = isoformat(self.timestamp)
+            elif field == '_links':
+                if has_next is None:
+                    has_next = Post.next_ids([self.id]) != set()
+                data[field] = {
+                    'self': url('api.get_post', self.id)
+                }
+                if self.id-1 > 0:
+                    data[field]['previous'] = url('api.get_post', self.id-1)
+                if has_next:
+                    data[field]['next'] = url('api.get_post', self.id+1)
+            else:
+                data[field] = getattr(self, field)
+        if 'author' in fieldset.expand:
+            if author is None and self.author is not None:
+                author = self.author.to_dict(fieldset=fieldset.expand['author'])
+            data['author'] = author
         return data
 
+    @staticmethod
+    def next_ids(ids):
+        # which of the posts with these ids have a post with the next id - in one query, by primary key
+        next_ids = db.session.query(Post.id).filter(Post.id.in_([id + 1 for id in ids]))
+        return {id - 1 for id, in next_ids}
+
+    @classmethod
+    def to_dicts(cls, items, fieldset=ALL):
+        # next links and authors for a whole page at once
+        next_ids = set()
+        if items and fieldset.wants('_links'):
+            next_ids = cls.next_ids([item.id for item in items])
+        authors = {}
+        if items and 'author' in fieldset.expand:
+            users = User.query.filter(User.id.in_({item.user_id for item in items})).all()
+            authors = {user.id: data for user, data in zip(users, User.to_dicts(users, fieldset.expand['author']))}
+        return [item.to_dict(fieldset=fieldset, has_next=item.id in next_ids, author=authors.get(item.user_id))
+                for item in items]
+
     def from_dict(self, data, current_user):
         # the code below works equally well for new posts and for old posts
         # the difference happens at a higher level function, where for new posts we call db.session/.add(), but for existing we only commit
@@ -338,6 +589,78 @@ class Post(PaginatedAPIMixin, SearchableMixin, db.Model):
         print('complete ok')
         # not returning anything, instead add and commit will happen in parent function
 
+    @staticmethod
+    def detect_languages(bodies):
+        # the language of each distinct text, worked out once however many posts share it
+        languages = {}
+        for body in set(bodies):
+            language = guess_language(body)
+            languages[body] = '' if language == 'UNKNOWN' or len(language) > 5 else language
+        return languages
+
+    @classmethod
+    def insert_many(cls, author, items):
+        # adds a batch of posts as plain inserts rather than through the session's unit of work. items are dicts
+        # with a body and optionally a language. returns the new posts (not in the session), in the same order
+        # note that's one INSERT per row, not an executemany: an executemany can't tell us the new ids on every database
+        # we run on, and finding the rows again afterwards isn't safe with other batches going in at the same time.
+        # what it still saves is the unit of work and the per-object events, and the rows all go in the caller's transaction
+        # the session hooks don't see these rows, so what they'd do for new posts is done here instead - apart from the
+        # search index, which wants add_many_to_index() once the caller has committed
+        if not items:
+            return []
+        languages = cls.detect_languages([item['body'] for item in items if not item.get('language')])
+        now = datetime.utcnow()
+        rows = [{'body': item['body'], 'language': item.get('language') or languages[item['body']],
+                 'user_id': author.id, 'timestamp': now, 'version': 1, 'updated_at': now} for item in items]
+        # return_defaults is what makes it one INSERT per row - each row's new id is written back into its dict
+        db.session.bulk_insert_mappings(cls, rows, return_defaults=True)
+        posts = [cls(**row) for row in rows]
+
+        # their author's post count changed
+        author.touch()
+        cache.queue_tags(db.session, 'user:{}'.format(author.id), 'posts')
+        timeline.queue_posts(db.session, posts)
+        for post in posts:
+            changes.queue(db.session, 'post', 'create', post.id, version=post.version)
+        return posts
+
+
+# reserves a slot for a new task, all in one go inside redis so two clicks can't both get through
+# KEYS = dedup key, active tasks of the user, active tasks of this type
+# ARGV = job id, now, slot expiry time, ttl, max tasks per user, max tasks per type (0 = no limit)
+# the active sets are sorted by expiry time, so slots of jobs that died without releasing them clear themselves
+TASK_RESERVE_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[2])
+redis.call('zremrangebyscore', KEYS[3], '-inf', ARGV[2])
+local existing = redis.call('get', KEYS[1])
+if existing then
+    return {'duplicate', existing}
+end
+if tonumber(ARGV[5]) > 0 and redis.call('zcard', KEYS[2]) >= tonumber(ARGV[5]) then
+    return {'limited', 'user'}
+end
+if tonumber(ARGV[6]) > 0 and redis.call('zcard', KEYS[3]) >= tonumber(ARGV[6]) then
+    return {'limited', 'type'}
+end
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[4])
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+redis.call('expire', KEYS[2], ARGV[4])
+redis.call('zadd', KEYS[3], ARGV[3], ARGV[1])
+redis.call('expire', KEYS[3], ARGV[4])
+return {'reserved', ARGV[1]}
+"""
+
+# gives the slot back - the dedup key is only removed if it still belongs to this job
+TASK_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+redis.call('zrem', KEYS[2], ARGV[1])
+redis.call('zrem', KEYS[3], ARGV[1])
+return 1
+"""
+
 
 class Task(db.Model):
     # redis queue itself is not a storage / history system. we need to separately store stuff in the database if we want to know how jobs went
@@ -346,6 +669,14 @@ class Task(db.Model):
     description = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     complete = db.Column(db.Boolean, default=False)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # path of the file the task produced, if any (eg the gzipped export written by export_posts)
+    artifact_path = db.Column(db.String(256))
+
+    # get_tasks_in_progress() uses the first two columns, get_task_in_progress() and get_completed_task() all three
+    __table_args__ = (
+        db.Index('ix_task_user_id_complete_name', 'user_id', 'complete', 'name'),
+    )
 
     def get_rq_job(self):
         try:
@@ -356,6 +687,20 @@ class Task(db.Model):
             return None
         return rq_job
 
+    @staticmethod
+    def slot_keys(user_id, name, args, kwargs):
+        # the redis keys used to deduplicate and limit tasks, see TASK_RESERVE_SCRIPT
+        digest = sha1(json.dumps([args, kwargs], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return ['task:dedup:{}:{}:{}'.format(user_id, name, digest),
+                'task:active:user:{}'.format(user_id),
+                'task:active:type:{}'.format(name)]
+
+    @staticmethod
+    def release_slot(connection, keys, job_id):
+        # connection can also be a pipeline, in which case this runs when the pipeline is executed
+        release = current_app.redis.register_script(TASK_RELEASE_SCRIPT)
+        release(keys=keys, args=[job_id], client=connection)
+
     def get_progress(self):
         job = self.get_rq_job()
         # assumption 1 - if job id not in the queue this means the job already finished and more than 500s passed and so we're returning 100
@@ -369,10 +714,64 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # the same for both directions between two users, see conversation_key()
+    conversation = db.Column(db.String(32))
+
+    # a conversation is read newest first, and so is an inbox
+    __table_args__ = (
+        db.Index('ix_message_conversation_timestamp', 'conversation', 'timestamp'),
+        db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),
+    )
 
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
+    @staticmethod
+    def conversation_key(user_id, other_id):
+        # lower id first, so john->susan and susan->john end up in the same conversation
+        return '{}:{}'.format(*sorted([user_id, other_id]))
+
+    # keyset pagination: a cursor points at a message, and pages are whatever comes right before/after it
+    # unlike offset pagination the db can jump straight there through the index, however deep the page is
+    def cursor(self):
+        return '{}_{}'.format(self.timestamp.strftime('%Y%m%d%H%M%S%f'), self.id)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        try:
+            timestamp, id = cursor.split('_')
+            return datetime.strptime(timestamp, '%Y%m%d%H%M%S%f'), int(id)
+        except (AttributeError, ValueError):
+            return None
+
+    @staticmethod
+    def conversation_page(key, per_page, before=None, after=None):
+        # returns (messages newest first, has_older, has_newer)
+        query = Message.query.filter_by(conversation=key)
+        before, after = Message.parse_cursor(before), Message.parse_cursor(after)
+        if after:
+            # walk forwards from the cursor, then flip the page around
+            messages = query.filter(db.or_(
+                Message.timestamp > after[0],
+                db.and_(Message.timestamp == after[0], Message.id > after[1]))).order_by(
+                Message.timestamp.asc(), Message.id.asc()).limit(per_page + 1).all()
+            has_newer = len(messages) > per_page
+            return list(reversed(messages[:per_page])), True, has_newer
+        if before:
+            query = query.filter(db.or_(
+                Message.timestamp < before[0],
+                db.and_(Message.timestamp == before[0], Message.id < before[1])))
+        messages = query.order_by(
+            Message.timestamp.desc(), Message.id.desc()).limit(per_page + 1).all()
+        return messages[:per_page], len(messages) > per_page, before is not None
+
+
+@db.event.listens_for(Message, 'before_insert')
+def set_conversation(mapper, connection, target):
+    # by now the sender and recipient ids are filled in, even if the message was created with author=/recipient= objects
+    if target.conversation is None and target.sender_id and target.recipient_id:
+        target.conversation = Message.conversation_key(target.sender_id, target.recipient_id)
+
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -381,5 +780,59 @@ class Notification(db.Model):
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
 
+    # one for replacing a notification by name, one for reading a user's notifications since some time
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name'),
+        db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     def get_data(self):
-        return json.loads(str(self.payload_json))
\ No newline at end of file
+        return json.loads(str(self.payload_json))
+
+
+class Change(db.Model):
+    # the change log behind /api/changes (see app/changes.py) - rows are only ever added, and the id is the cursor
+    # follows are stored as follower (object_id) and followed (related_id)
+    __tablename__ = 'change_log'
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    type = db.Column(db.String(16))
+    action = db.Column(db.String(8))
+    object_id = db.Column(db.Integer)
+    related_id = db.Column(db.Integer)
+    version = db.Column(db.Integer)
+
+    def to_dict(self):
+        data = {
+            'cursor': self.id,
+            'timestamp': isoformat(self.timestamp),
+            'type': self.type,
+            'action': self.action,
+        }
+        if self.type == 'follow':
+            data['follower_id'] = self.object_id
+            data['followed_id'] = self.related_id
+        else:
+            data['id'] = self.object_id
+            data['version'] = self.version
+            if self.action != 'delete':
+                data['_links'] = {'self': url('api.get_{}'.format(self.type), self.object_id)}
+        return data
+
+
+class Checkpoint(db.Model):
+    # how far a recurring job got last time (eg the last message id the digest job covered), so it can carry on from there
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.String(64))
+
+    @staticmethod
+    def get(name, default=None):
+        checkpoint = Checkpoint.query.get(name)
+        return checkpoint.value if checkpoint else default
+
+    @staticmethod
+    def set(name, value):
+        # like everywhere else, the caller commits
+        checkpoint = Checkpoint.query.get(name) or Checkpoint(name=name)
+        checkpoint.value = str(value)
+        db.session.add(checkpoint)
@@ -0,0 +1,176 @@
+# live notifications: User.add_notification() queues them up, they get published to redis once the transaction
+# commits, and the /notifications/stream endpoint pushes them to the browser as server-sent events
+# where they're kept depends on NOTIFICATION_BACKEND - either Notification rows in the db ('sql') or redis ('redis')
+
+import json
+import logging
+import time
+
+import redis
+from flask import current_app
+
+
+def channel(user_id):
+    return 'notifications:{}'.format(user_id)
+
+
+class SQLNotificationStore(object):
+    # the original storage - one Notification row per user and name
+
+    def add(self, session, user, name, data):
+        from app.models import Notification
+        # if a notification with a similar name already exists - we delete it first
+        user.notifications.filter_by(name=name).delete()
+        n = Notification(name=name, payload_json=json.dumps(data), user=user,
+                         timestamp=time.time())
+        session.add(n)
+        # the row is already stored by the commit, so only the publishing is left for later
+        queue_notification(session, user.id, {
+            'name': name, 'data': data, 'timestamp': n.timestamp}, store=False)
+        return n
+
+    def add_many(self, session, name, data_by_user_id):
+        # the same as add() for lots of users at once - one delete and one multi-row insert, whatever the number of users
+        from app.models import Notification
+        if not data_by_user_id:
+            return
+        session.query(Notification).filter(
+            Notification.user_id.in_(data_by_user_id.keys()),
+            Notification.name == name).delete(synchronize_session=False)
+        now = time.time()
+        session.execute(Notification.__table__.insert(), [
+            {'name': name, 'user_id': user_id, 'payload_json': json.dumps(data), 'timestamp': now}
+            for user_id, data in data_by_user_id.items()])
+        for user_id, data in data_by_user_id.items():
+            queue_notification(session, user_id, {
+                'name': name, 'data': data, 'timestamp': now}, store=False)
+
+    def since(self, user, since):
+        from app.models import Notification
+        return [{
+            'name': n.name,
+            'data': n.get_data(),
+            'timestamp': n.timestamp
+        } for n in user.notifications.filter(
+            Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+
+
+# reads the notifications newer than ARGV[1] in one go - names from the sorted set, then their payloads from the hash
+REDIS_SINCE_SCRIPT = """
+local names = redis.call('zrangebyscore', KEYS[2], '(' .. ARGV[1], '+inf')
+if #names == 0 then
+    return {}
+end
+return redis.call('hmget', KEYS[1], unpack(names))
+"""
+
+
+class RedisNotificationStore(object):
+    # keeps each user's notifications in redis instead of the db, which saves two write statements on every
+    # unread-count change. a hash holds the latest payload per name, and a sorted set orders the names by timestamp
+
+    @staticmethod
+    def keys(user_id):
+        return ['notifications:{}:data'.format(user_id),
+                'notifications:{}:index'.format(user_id)]
+
+    def add(self, session, user, name, data):
+        payload = {'name': name, 'data': data, 'timestamp': time.time()}
+        # like the db version, nothing is written until the transaction commits
+        queue_notification(session, user.id, payload, store=True)
+        return payload
+
+    def add_many(self, session, name, data_by_user_id):
+        # all of these get written in the same pipeline after the commit anyway
+        now = time.time()
+        for user_id, data in data_by_user_id.items():
+            queue_notification(session, user_id, {
+                'name': name, 'data': data, 'timestamp': now}, store=True)
+
+    def write(self, pipe, user_id, payload):
+        # replaces any earlier notification with the same name. runs inside the MULTI/EXEC of publish_queued,
+        # so readers never see the hash and the sorted set disagree
+        data_key, index_key = self.keys(user_id)
+        ttl = current_app.config['NOTIFICATION_TTL']
+        pipe.hset(data_key, payload['name'], json.dumps(payload))
+        pipe.zadd(index_key, {payload['name']: payload['timestamp']})
+        pipe.expire(data_key, ttl)
+        pipe.expire(index_key, ttl)
+
+    def since(self, user, since):
+        read = current_app.redis.register_script(REDIS_SINCE_SCRIPT)
+        return [json.loads(payload) for payload in read(
+            keys=self.keys(user.id), args=[repr(float(since))]) if payload]
+
+
+stores = {
+    'sql': SQLNotificationStore(),
+    'redis': RedisNotificationStore()
+}
+
+
+def get_store():
+    return stores[current_app.config['NOTIFICATION_BACKEND']]
+
+
+def queue_notification(session, user_id, payload, store=False):
+    # we can't write or publish straight away - if the transaction gets rolled back the notification never existed
+    session.info.setdefault('notifications', []).append((user_id, payload, store))
+
+
+def publish_queued(session):
+    # triggered after each commit
+    queued = session.info.pop('notifications', None)
+    if not queued:
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        for user_id, payload, store in queued:
+            if store:
+                stores['redis'].write(pipe, user_id, payload)
+            pipe.publish(channel(user_id), json.dumps(payload))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        if any(store for user_id, payload, store in queued):
+            current_app.logger.error('could not store notifications', exc_info=True)
+        else:
+            # not the end of the world - the notification is in the db, and clients pick it up when they reconnect
+            logging.debug('could not publish notifications', exc_info=True)
+
+
+def discard_queued(session, previous_transaction=None):
+    # triggered after a rollback
+    session.info.pop('notifications', None)
+
+
+def format_event(payload):
+    # the timestamp doubles as the event id, so a reconnecting browser tells us (in Last-Event-ID) where it left off
+    return 'id: {}\ndata: {}\n\n'.format(payload['timestamp'], json.dumps(payload))
+
+
+def stream(pubsub, missed, heartbeat, timeout):
+    # pubsub must already be subscribed before `missed` is read from the db, otherwise anything sent in between is lost
+    # the stream ends after `timeout` seconds so we don't hold on to a server worker forever - the browser just reconnects
+    try:
+        # tells the browser how long to wait before reconnecting, in ms
+        yield 'retry: {}\n\n'.format(heartbeat * 1000)
+        last = 0
+        for payload in missed:
+            last = payload['timestamp']
+            yield format_event(payload)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                # comment line, ignored by the browser - keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            if message['type'] != 'message':
+                continue
+            payload = json.loads(message['data'])
+            # skip whatever we already replayed from the db
+            if payload['timestamp'] > last:
+                last = payload['timestamp']
+                yield format_event(payload)
+    finally:
+        pubsub.close()
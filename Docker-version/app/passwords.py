@@ -0,0 +1,58 @@
+# password hashing. the method (eg 'pbkdf2:sha256:150000' - algorithm and iterations) and salt length come from
+# PASSWORD_HASH_METHOD / PASSWORD_SALT_LENGTH, and a hash made with older settings is replaced with a new one the
+# next time its owner logs in successfully (see User.check_password)
+#
+# hashing is deliberately slow, so it runs on a small pool of threads (app.password_hasher, set up in create_app)
+# rather than however many requests happen to be logging in at once. hashlib releases the GIL while it works, so
+# other requests keep going meanwhile. once PASSWORD_HASH_WORKERS are busy and PASSWORD_HASH_QUEUE more are
+# waiting, further logins get a 503 instead of piling up
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
+
+class PasswordHasher(object):
+
+    def __init__(self, app):
+        self.executor = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'],
+                                           thread_name_prefix='password-hasher')
+        self.slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS'] +
+                                                app.config['PASSWORD_HASH_QUEUE'])
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+    def run(self, f, *args):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PasswordHashingBusy()
+        try:
+            return self.executor.submit(f, *args).result()
+        finally:
+            self.slots.release()
+
+
+def hash_password(password):
+    return current_app.password_hasher.run(
+        generate_password_hash, password,
+        current_app.config['PASSWORD_HASH_METHOD'], current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def check_password(pwhash, password):
+    return current_app.password_hasher.run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    # hashes look like method$salt$hash - anything not made with the current settings gets replaced
+    if not pwhash or pwhash.count('$') < 2:
+        return True
+    method, salt = pwhash.split('$')[:2]
+    wanted = current_app.config['PASSWORD_HASH_METHOD']
+    if wanted.startswith('pbkdf2:') and wanted.count(':') == 1:
+        # werkzeug fills in its default number of iterations and stores that in the hash
+        wanted += ':{}'.format(DEFAULT_PBKDF2_ITERATIONS)
+    return method != wanted or len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
@@ -2,6 +2,7 @@
 # specifically we need 3 functions - add something to index, remove, query
 # the other good thing about this funcitonality is that it's GENERIC - we can apply it to any model we want
 
+from elasticsearch import helpers
 from flask import current_app
 
 
@@ -17,6 +18,15 @@ def add_to_index(index, model):
     current_app.elasticsearch.index(index=index, id=model.id, body=payload)
 
 
+def add_many_to_index(index, models):
+    # the same for a whole batch, in a single bulk request
+    if not current_app.elasticsearch or not models:
+        return
+    actions = [{'_index': index, '_id': model.id,
+                '_source': {field: getattr(model, field) for field in model.__searchable__}} for model in models]
+    helpers.bulk(current_app.elasticsearch, actions)
+
+
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
@@ -0,0 +1,81 @@
+# turning api representations into json quickly
+# - json_response() is what the api uses instead of flask's jsonify. it uses orjson when it's installed
+#   (pip install orjson), which is several times faster than the json module, and falls back to the json module
+#   otherwise. either way the output is compact - no pretty printing
+# - url_template() builds the url for an endpoint once and then fills in the id with string formatting, instead of
+#   going through url_for (and the whole url map) for every link of every object on a page
+# - datetimes go out as iso 8601 utc times, eg 2020-05-17T10:02:34.532518Z, wherever they come from
+
+import json
+from datetime import datetime
+
+from flask import current_app, request, url_for
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def isoformat(value):
+    # our datetimes are naive utc
+    return value.isoformat() + 'Z' if value is not None else None
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return isoformat(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def dumps(data):
+    # returns utf-8 encoded bytes
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, default=_default, separators=(',', ':')).encode()
+
+
+def json_response(data, status_code=200):
+    return current_app.response_class(dumps(data), status=status_code, mimetype='application/json')
+
+
+# stands in for the id while building a template - any int the url converters accept will do
+_PLACEHOLDER = 1234567890123
+_templates = {}
+
+
+def url_template(endpoint):
+    # urls depend on where the app is mounted, so templates are kept per script root
+    key = (endpoint, request.script_root)
+    template = _templates.get(key)
+    if template is None:
+        template = url_for(endpoint, id=_PLACEHOLDER).replace(str(_PLACEHOLDER), '{}')
+        _templates[key] = template
+    return template
+
+
+def url(endpoint, id):
+    # same as url_for(endpoint, id=id) for endpoints whose only argument is an int id
+    return url_template(endpoint).format(id)
+
+
+class Fieldset(object):
+    # which parts of a representation to build (?fields= and ?expand= in the api, see app/api/fields.py)
+    # fields: the names to include, or None for all of them
+    # expand: related resources to include as well, name -> Fieldset for that resource
+
+    def __init__(self, fields=None, expand=None, args=None):
+        self.fields = fields
+        self.expand = expand or {}
+        # the query arguments this came from, so pagination links can pass them on
+        self.args = args or {}
+
+    def wants(self, field):
+        return self.fields is None or field in self.fields
+
+    def select(self, fields):
+        # the requested fields in the order the resource lists them
+        return fields if self.fields is None else [field for field in fields if field in self.fields]
+
+
+ALL = Fieldset()
@@ -1,83 +1,243 @@
+import gzip
 import json
 import logging
+import os
 import sys
 import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
 
-from flask import render_template, send_file, jsonify, url_for
+from flask import current_app, has_app_context, render_template
+from flask_mail import Message as EmailMessage
 from rq import get_current_job
-from werkzeug.utils import redirect
 
-from app import create_app, db
+from app import create_app, db, notifications
 
 # because this is going to run in a separate process, we need to instantiate flask-sql-alchemy (to write to db) and flask-mail (to send an email to the user)
 # and for that we need an instance of our app
-from app.email import send_email
-from app.models import Task, User, Post
+from app.email import deliver
+from app.models import Task, User, Post, Message, Checkpoint, followers
 
-app = create_app()
-app.app_context().push()
+# workers started with `flask worker` (see app/worker.py) build the app once and already run inside its context,
+# but if we get imported by a plain `rq worker` we still have to make one ourselves
+if not has_app_context():
+    app = create_app()
+    app.app_context().push()
 
 logging.basicConfig(filename='rq.log', level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+# what we last reported for the job this worker is running, as {job_id: (progress, time)}
+# a worker only runs one job at a time, so this never holds more than one entry
+_reported_progress = {}
+
+
+def _should_report_progress(job_id, progress, now):
+    # progress only gets written out if it moved by at least TASK_PROGRESS_MIN_DELTA percent or if
+    # TASK_PROGRESS_MIN_INTERVAL seconds passed since the last write - so a job costs a handful of writes, not one per item
+    last = _reported_progress.get(job_id)
+    if last is None:
+        return True
+    last_progress, last_time = last
+    if progress >= 100:
+        # completion is reported exactly once, even though export_posts also sends 100 from its finally block
+        return last_progress < 100
+    return progress - last_progress >= current_app.config['TASK_PROGRESS_MIN_DELTA'] or \
+        now - last_time >= current_app.config['TASK_PROGRESS_MIN_INTERVAL']
+
+
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
+        now = time.time()
+        if not _should_report_progress(job.get_id(), progress, now):
+            return
+        if job.get_id() not in _reported_progress:
+            _reported_progress.clear()
+        _reported_progress[job.get_id()] = (progress, now)
+
         # write & save the % completion to meta dictionary in redis
+        # this is what job.save_meta() does, but through a pipeline so that anything else we report alongside goes in the same round trip
         job.meta['progress'] = progress
-        job.save_meta()
+        pipe = job.connection.pipeline(transaction=False)
+        pipe.hset(job.key, 'meta', job.serializer.dumps(job.meta))
+        if progress >= 100 and 'slot_keys' in job.meta:
+            # free up the slot launch_task reserved, so the user can queue this task again
+            Task.release_slot(pipe, job.meta['slot_keys'], job.get_id())
+        pipe.execute()
 
-        task = Task.query.get(job.get_id())  # get task from db
-        # SKIPPING NOTIFICATIONS BECAUSE I DIDN'T IMPLEMENT THEM
-        # task.user.add_notifications('task_progress', {'task_id': job.get_id(), 'progress': progress})
+        # the db only needs to hear about the task once it's done
         if progress >= 100:
+            task = Task.query.get(job.get_id())  # get task from db
+            # SKIPPING NOTIFICATIONS BECAUSE I DIDN'T IMPLEMENT THEM
+            # task.user.add_notifications('task_progress', {'task_id': job.get_id(), 'progress': progress})
             task.complete = True #set it as true if done
-        db.session.commit() #finally commit to db
+            db.session.commit() #finally commit to db
+
+
+def _export_path(task_id):
+    # one file per task, so a user can download any of their previous exports
+    folder = current_app.config['EXPORT_FOLDER']
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, '{}.jsonl.gz'.format(task_id))
 
 
 def export_posts(user_id):
     # because this process is run by RQ not by flask, we need to manually handle exceptions.
     # otherwise, unless we're watching the RQ logs all the time, we won't know that this has completed
+    path = None
     try:
-        # read user posts from db
+        job = get_current_job()
         user = User.query.get(user_id)
         _set_task_progress(0)
-        data = []
         i = 0
         total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.timestamp.asc()):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'}) #z means UTC
-            time.sleep(5) #fake adding time
-            i += 1
-            logging.debug(f"i is {i}, progress is {i//total_posts}")
-            _set_task_progress(100 * i // total_posts)
-
-        # send email with data to user
-        # send_email('[Microblog] Your blog posts',
-        #         sender=app.config['ADMINS'][0], recipients=[user.email],
-        #         text_body=render_template('email/export_posts.txt', user=user),
-        #         html_body=render_template('email/export_posts.html', user=user),
-        #         attachments=[('posts.json', 'application/json',
-        #                       json.dumps({'posts': data}, indent=4))],
-        #         sync=True)
-        # redirect(url_for('main.display_posts', data=data))
-
-        # doesn't work coz we're doing from worker
-        # print('sending file...')
-        # return send_file('cli.py', as_attachment=True,
-        #                  attachment_filename='cli.py')
-        # _set_task_progress(100)
-        # return data
+        chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+
+        # we only select the two columns we need instead of full Post objects, and yield_per makes the db hand them
+        # over in chunks - so no matter how many posts the user has, only one chunk is ever held in memory
+        posts = db.session.query(Post.body, Post.timestamp).filter(
+            Post.user_id == user_id).order_by(Post.timestamp.asc()).yield_per(chunk_size)
+
+        # each post is written out as one line of json (JSON Lines) and gzipped on the fly
+        # we write to a temporary file first and only rename it at the end, so a half-written export is never served
+        path = _export_path(job.get_id() if job else 'user-{}'.format(user_id))
+        with gzip.open(path + '.part', 'wt', encoding='utf-8') as f:
+            for body, timestamp in posts:
+                f.write(json.dumps({'body': body,
+                                    'timestamp': timestamp.isoformat() + 'Z'}) + '\n') #z means UTC
+                i += 1
+                # 100% (which commits to the db) is only reported once the file is done, never while the cursor is open
+                _set_task_progress(min(100 * i // total_posts, 99))
+        os.replace(path + '.part', path)
+        logging.debug(f"exported {i} posts for user {user_id} to {path}")
+
+        # record where the export ended up, so that the download endpoint can find it
+        if job:
+            task = Task.query.get(job.get_id())
+            task.artifact_path = path
+            db.session.commit()
     except:
         # log the error by collecting traceback info
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        if path and os.path.exists(path + '.part'):
+            os.remove(path + '.part')
     finally:
         # mark progress to 100 and task as completed
         _set_task_progress(100)
 
 
+def broadcast_message(user_id, body):
+    # sends the same private message to every follower of user_id
+    # followers are handled a chunk at a time: one multi-row insert for the messages, one grouped query for
+    # the new unread counts, and one bulk update of the notifications - instead of all of that per follower
+    try:
+        _set_task_progress(0)
+        chunk_size = current_app.config['BROADCAST_CHUNK_SIZE']
+        total = db.session.query(db.func.count()).select_from(followers).filter(
+            followers.c.followed_id == user_id).scalar()
+        done = 0
+        last_id = 0
+        while True:
+            # walk the follower ids in order rather than keeping one cursor open, because we commit after every chunk
+            ids = [id for id, in db.session.query(followers.c.follower_id).filter(
+                followers.c.followed_id == user_id, followers.c.follower_id > last_id).order_by(
+                followers.c.follower_id).limit(chunk_size)]
+            if not ids:
+                break
+            now = datetime.utcnow()
+            # Core inserts skip the ORM events, so the conversation key is filled in here
+            db.session.execute(Message.__table__.insert(), [
+                {'sender_id': user_id, 'recipient_id': id, 'body': body, 'timestamp': now,
+                 'conversation': Message.conversation_key(user_id, id)} for id in ids])
+            # same as User.new_messages(), for the whole chunk at once
+            unread = dict(db.session.query(Message.recipient_id, db.func.count(Message.id)).join(
+                User, User.id == Message.recipient_id).filter(
+                Message.recipient_id.in_(ids),
+                Message.timestamp > db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))).group_by(
+                Message.recipient_id))
+            notifications.get_store().add_many(db.session, 'unread_message_count',
+                                               {id: unread.get(id, 0) for id in ids})
+            db.session.commit()
+            done += len(ids)
+            last_id = ids[-1]
+            _set_task_progress(min(100 * done // total, 99))
+        logging.debug(f"broadcast from user {user_id} sent to {done} followers")
+    except:
+        db.session.rollback()
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        _set_task_progress(100)
+
+
+def _collect_digests(since_follow, until_follow, since_message_id, until_message_id):
+    # one pass over each table for everything that happened in the window, grouped by the user it happened to
+    digests = defaultdict(lambda: {'new_followers': [], 'message_senders': Counter()})
+    new_follows = db.session.query(followers.c.followed_id, User.username).join(
+        User, User.id == followers.c.follower_id).filter(
+        followers.c.timestamp > since_follow, followers.c.timestamp <= until_follow)
+    for user_id, username in new_follows.yield_per(1000):
+        digests[user_id]['new_followers'].append(username)
+    new_messages = db.session.query(Message.recipient_id, User.username).join(
+        User, User.id == Message.sender_id).filter(
+        Message.id > since_message_id, Message.id <= until_message_id)
+    for user_id, username in new_messages.yield_per(1000):
+        digests[user_id]['message_senders'][username] += 1
+    return digests
+
+
+def send_digests(reschedule=True):
+    # emails every user a summary of their new followers and private messages since the last run
+    # where the last run stopped is kept in Checkpoint rows, so each run only looks at what's new
+    try:
+        # leave the last few seconds alone, transactions still in flight might add rows there
+        until_follow = datetime.utcnow() - timedelta(seconds=current_app.config['DIGEST_LAG'])
+        until_message_id = db.session.query(db.func.max(Message.id)).filter(
+            Message.timestamp <= until_follow).scalar() or 0
+        # the very first run starts from now, rather than emailing everyone about everything that ever happened
+        follow_mark = Checkpoint.get('digest.followers')
+        since_follow = datetime.strptime(follow_mark, '%Y-%m-%dT%H:%M:%S.%f') if follow_mark else until_follow
+        since_message_id = int(Checkpoint.get('digest.messages', until_message_id))
+        digests = _collect_digests(since_follow, until_follow, since_message_id, until_message_id)
+
+        # load all the recipients in one query, render each email from the (cached) templates, and send them
+        # over a handful of smtp connections instead of one per email
+        batch = []
+        batch_size = current_app.config['MAIL_BATCH_SIZE']
+        for user in User.query.filter(User.id.in_(digests.keys())) if digests else []:
+            if not user.email:
+                continue
+            digest = digests[user.id]
+            context = {'user': user, 'new_followers': digest['new_followers'],
+                       'message_senders': sorted(digest['message_senders'].items())}
+            msg = EmailMessage('[Microblog] What you missed', sender=current_app.config['ADMINS'][0],
+                               recipients=[user.email])
+            msg.body = render_template('email/digest.txt', **context)
+            msg.html = render_template('email/digest.html', **context)
+            batch.append(msg)
+            if len(batch) >= batch_size:
+                deliver(batch)
+                batch = []
+        if batch:
+            deliver(batch)
+
+        # only move the high-water marks once the emails are out
+        Checkpoint.set('digest.followers', until_follow.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        Checkpoint.set('digest.messages', max(until_message_id, since_message_id))
+        db.session.commit()
+        logging.debug(f"sent {len(digests)} digests")
+    except:
+        db.session.rollback()
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        if reschedule:
+            # needs a worker running the rq scheduler (flask worker --with-scheduler)
+            current_app.task_queue.enqueue_in(timedelta(seconds=current_app.config['DIGEST_INTERVAL']),
+                                              'app.tasks.send_digests')
+
+
 # def example(seconds):
 #     # redis stuff - fetch current job
 #     job = get_current_job()
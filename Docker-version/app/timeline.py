@@ -0,0 +1,211 @@
+# home page timelines kept in redis, for TIMELINE_MODE = 'hybrid' (the default 'pull' just runs followed_posts())
+#
+# pushing every new post into the timeline of each follower makes reads cheap, but an account with lots of followers
+# turns one post into that many writes. so it's a mix:
+#  - authors with up to TIMELINE_FANOUT_THRESHOLD followers get their posts pushed into each follower's timeline
+#    (a sorted set of post ids, scored by time) once the post is committed
+#  - posts from authors above the threshold aren't pushed anywhere - readers pull them from the author's own short list
+#    of recent posts and merge them in
+# a missing list of recent posts (or timeline) is rebuilt from the db when read, so an author can cross the threshold at any time
+# while that happens posts are also pushed to a "building" key, which gets merged in - otherwise a post committed between
+# reading the db and writing the rebuilt set would be in neither
+# timelines only hold the newest TIMELINE_LENGTH posts, older pages (and any redis trouble) fall back to followed_posts()
+
+import logging
+from datetime import datetime
+
+import redis
+from flask import current_app
+
+from app import db
+
+# sorted sets only get added to when they're already there - a missing one is rebuilt from the db when it's next read,
+# and adding to it now would make it look complete with just this one post in it
+# ARGV: post id, score, how many entries to keep
+REDIS_PUSH_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        redis.call('zadd', key, ARGV[2], ARGV[1])
+        redis.call('zremrangebyrank', key, 0, -tonumber(ARGV[3]) - 1)
+    end
+end
+"""
+
+# stands in for "no posts" so an empty timeline still exists. ids start at 1 so it can't clash with a post
+EMPTY = '0'
+
+
+def timeline_key(user_id):
+    return 'timeline:{}'.format(user_id)
+
+
+def recent_key(user_id):
+    return 'timeline:recent:{}'.format(user_id)
+
+
+def building_key(key):
+    return key + ':building'
+
+
+# how long a rebuild gets to read the db before its building key goes away
+BUILD_TTL = 60
+
+
+# the authors whose posts are pulled rather than pushed
+PULLED_KEY = 'timeline:pulled'
+
+
+def score(timestamp):
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+
+def enabled():
+    return current_app.config['TIMELINE_MODE'] == 'hybrid'
+
+
+def collect_posts(session, flush_context):
+    # triggered after each flush. the new posts have their ids by now, and unlike after_commit we can still
+    # query the db here - so this is where we work out who each post needs to be pushed to
+    from app.models import Post
+    queue_posts(session, [post for post in session.new if isinstance(post, Post)])
+
+
+def queue_posts(session, posts):
+    # also used directly for posts inserted without the session (see Post.insert_many)
+    if not enabled():
+        return
+    from app.models import followers
+    threshold = current_app.config['TIMELINE_FANOUT_THRESHOLD']
+    audiences = {}
+    for post in posts:
+        if post.user_id not in audiences:
+            follower_count = session.execute(db.select([db.func.count()]).select_from(followers).where(
+                followers.c.followed_id == post.user_id)).scalar()
+            if follower_count > threshold:
+                audiences[post.user_id] = [], True
+            else:
+                audiences[post.user_id] = [id for id, in session.execute(db.select([followers.c.follower_id]).where(
+                    followers.c.followed_id == post.user_id))], False
+        recipients, pulled = audiences[post.user_id]
+        # authors always see their own posts
+        session.info.setdefault('timeline_posts', []).append(
+            (post.id, post.user_id, score(post.timestamp), recipients + [post.user_id], pulled))
+
+
+def queue_reset(session, user_id):
+    # after a follow/unfollow the pushed timeline has the wrong authors in it - it's simply rebuilt on the next read
+    if enabled():
+        session.info.setdefault('timeline_resets', []).append(user_id)
+
+
+def publish_queued(session):
+    # triggered after each commit
+    posts = session.info.pop('timeline_posts', None)
+    resets = session.info.pop('timeline_resets', None)
+    if not posts and not resets:
+        return
+    length = current_app.config['TIMELINE_LENGTH']
+    push = current_app.redis.register_script(REDIS_PUSH_SCRIPT)
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for post_id, author_id, post_score, recipients, pulled in posts or []:
+            keys = [recent_key(author_id)] + [timeline_key(id) for id in recipients]
+            push(keys=keys + [building_key(key) for key in keys], args=[post_id, post_score, length], client=pipe)
+            if pulled:
+                pipe.sadd(PULLED_KEY, author_id)
+        for user_id in resets or []:
+            pipe.delete(timeline_key(user_id))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        # anything missed here is stale until the timeline expires (TIMELINE_TTL), so say so
+        current_app.logger.error('could not update timelines', exc_info=True)
+
+
+def discard_queued(session, previous_transaction=None):
+    # triggered after a rollback
+    session.info.pop('timeline_posts', None)
+    session.info.pop('timeline_resets', None)
+
+
+def _latest(query):
+    # the newest TIMELINE_LENGTH posts from the db, with the EMPTY marker so the set exists even with no posts
+    from app.models import Post
+    entries = {EMPTY: 0}
+    for id, timestamp in query.with_entities(Post.id, Post.timestamp).order_by(
+            Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH']):
+        entries[str(id)] = score(timestamp)
+    return entries
+
+
+def _rebuild(rebuilds):
+    # rebuilds is a list of (key, query) pairs. the building keys exist before the db is read, so anything committed
+    # from then on is pushed into them, and they're merged with what the db had
+    r = current_app.redis
+    length = current_app.config['TIMELINE_LENGTH']
+    pipe = r.pipeline()
+    for key, query in rebuilds:
+        pipe.zadd(building_key(key), {EMPTY: 0})
+        pipe.expire(building_key(key), BUILD_TTL)
+    pipe.execute()
+    latest = [(key, _latest(query)) for key, query in rebuilds]
+    pipe = r.pipeline()
+    for key, entries in latest:
+        # a union rather than a rename, in case another rebuild of the same key finished first and got pushes since
+        pipe.zadd(building_key(key), entries)
+        pipe.zunionstore(key, [key, building_key(key)], aggregate='MAX')
+        pipe.delete(building_key(key))
+        pipe.zremrangebyrank(key, 0, -length - 1)
+        pipe.expire(key, current_app.config['TIMELINE_TTL'])
+    pipe.execute()
+
+
+def followed_post_ids(user, start, count):
+    # ids of the posts for positions start..start+count of the user's home timeline, newest first
+    # returns None when that's beyond what the redis timelines hold
+    length = current_app.config['TIMELINE_LENGTH']
+    if start + count > length:
+        return None
+    r = current_app.redis
+    if not r.exists(timeline_key(user.id)):
+        _rebuild([(timeline_key(user.id), user.followed_posts())])
+    pulled = [int(id) for id in r.smembers(PULLED_KEY)]
+    pulled = user.is_following_many(pulled) if pulled else set()
+    missing = [id for id in pulled if not r.exists(recent_key(id))]
+    if missing:
+        from app.models import Post
+        _rebuild([(recent_key(id), Post.query.filter_by(user_id=id)) for id in missing])
+
+    # the first start+count entries of each list are enough to know the first start+count of the merged timeline
+    pipe = r.pipeline(transaction=False)
+    pipe.zrevrange(timeline_key(user.id), 0, start + count - 1, withscores=True)
+    pipe.expire(timeline_key(user.id), current_app.config['TIMELINE_TTL'])
+    for id in pulled:
+        pipe.zrevrange(recent_key(id), 0, start + count - 1, withscores=True)
+    results = pipe.execute()
+    entries = {}
+    for result in [results[0]] + results[2:]:
+        for id, entry_score in result:
+            if id != EMPTY.encode():
+                entries[int(id)] = entry_score
+    merged = sorted(entries, key=lambda id: (entries[id], id), reverse=True)
+    return merged[start:start + count]
+
+
+def followed_posts_page(user, page, per_page):
+    # the posts for one page of the home timeline plus whether there's a next page, or None if this has to
+    # go to the db instead
+    from app.models import Post
+    if not enabled():
+        return None
+    try:
+        # one extra to find out if there's a next page
+        ids = followed_post_ids(user, (page - 1) * per_page, per_page + 1)
+    except redis.exceptions.RedisError:
+        logging.warning('timeline unavailable, reading from the db', exc_info=True)
+        return None
+    if ids is None:
+        return None
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(ids))} if ids else {}
+    return [posts[id] for id in ids if id in posts], has_next
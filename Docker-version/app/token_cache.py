@@ -0,0 +1,136 @@
+# remembers which user an api token belongs to and when it expires, so authenticating an api request doesn't need
+# a query each time. set up as app.token_cache in create_app
+# TOKEN_CACHE_BACKEND: 'redis' (the default, shared by all processes), 'local' (per process, at most TOKEN_CACHE_SIZE
+# tokens) or 'null' (always ask the db). entries are kept for at most TOKEN_CACHE_TTL seconds
+# the expiry time itself is cached, so expired tokens are turned away exactly on time either way. get_token() and
+# revoke_token() drop the old entry once their transaction commits - with the 'local' backend only in the process
+# that made the change though, other processes may keep accepting a revoked token for up to TOKEN_CACHE_TTL seconds.
+# so 'local' is only for running a single process
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+
+import redis
+from flask import current_app
+
+
+class LocalTokenCache(object):
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            expires, user_id, expiration = entry
+            if expires < time.time():
+                del self.entries[token]
+                return None
+            self.entries.move_to_end(token)
+            return user_id, expiration
+
+    def set(self, token, user_id, expiration):
+        with self.lock:
+            self.entries[token] = (time.time() + self.ttl, user_id, expiration)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, tokens):
+        with self.lock:
+            for token in tokens:
+                self.entries.pop(token, None)
+
+
+class RedisTokenCache(object):
+
+    def __init__(self, connection, ttl):
+        self.redis = connection
+        self.ttl = ttl
+
+    @staticmethod
+    def key(token):
+        # only a hash of the token ends up in redis
+        return 'token:' + sha1(token.encode()).hexdigest()
+
+    def get(self, token):
+        value = self.redis.get(self.key(token))
+        if value is None:
+            return None
+        user_id, expiration = value.decode().split(':')
+        return int(user_id), datetime.utcfromtimestamp(float(expiration))
+
+    def set(self, token, user_id, expiration):
+        timestamp = (expiration - datetime(1970, 1, 1)).total_seconds()
+        self.redis.set(self.key(token), '{}:{}'.format(user_id, timestamp), ex=self.ttl)
+
+    def delete(self, tokens):
+        self.redis.delete(*[self.key(token) for token in tokens])
+
+
+class NullTokenCache(object):
+
+    def get(self, token):
+        return None
+
+    def set(self, token, user_id, expiration):
+        pass
+
+    def delete(self, tokens):
+        pass
+
+
+def make_token_cache(app):
+    backend = app.config['TOKEN_CACHE_BACKEND']
+    if backend == 'local':
+        return LocalTokenCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+    if backend == 'null':
+        return NullTokenCache()
+    return RedisTokenCache(app.redis, app.config['TOKEN_CACHE_TTL'])
+
+
+def lookup(token):
+    # (user id, expiration) for a token, or None if it isn't cached
+    try:
+        return current_app.token_cache.get(token)
+    except redis.exceptions.RedisError:
+        logging.debug('token cache unavailable', exc_info=True)
+        return None
+
+
+def store(token, user_id, expiration):
+    try:
+        current_app.token_cache.set(token, user_id, expiration)
+    except redis.exceptions.RedisError:
+        logging.debug('token cache unavailable', exc_info=True)
+
+
+def queue_invalidation(session, token):
+    if token:
+        session.info.setdefault('stale_tokens', []).append(token)
+
+
+def invalidate_queued(session):
+    # triggered after each commit
+    tokens = session.info.pop('stale_tokens', None)
+    if not tokens:
+        return
+    try:
+        current_app.token_cache.delete(tokens)
+    except redis.exceptions.RedisError:
+        # a revoked token could keep working for up to TOKEN_CACHE_TTL seconds, so this is worth shouting about
+        current_app.logger.error('could not remove tokens from the token cache', exc_info=True)
+
+
+def discard_queued(session, previous_transaction=None):
+    # triggered after a rollback
+    session.info.pop('stale_tokens', None)
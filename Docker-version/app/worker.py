@@ -0,0 +1,103 @@
+# runs a small pool of RQ worker processes for the task queue, and keeps it topped up
+# this is what the `flask worker` command (see cli.py) calls
+
+import importlib
+import logging
+import os
+import signal
+import time
+
+import rq
+from flask import current_app
+
+from app import create_app, db
+
+
+def _work(app, slot, queue_name, max_jobs, with_scheduler):
+    # runs in the child process. everything in here reuses the same flask app for every job it picks up
+    with app.app_context():
+        # importing the tasks here means they're loaded once per process, not once per job
+        importlib.import_module('app.tasks')
+        # SimpleWorker runs jobs in this process instead of forking a new one per job, so the app,
+        # the db connection pool and the redis connection all stay warm between jobs
+        worker = rq.SimpleWorker([queue_name], connection=app.redis,
+                                 name='{}.{}.{}'.format(queue_name, os.getpid(), slot))
+        started = time.time()
+        worker.work(max_jobs=max_jobs, with_scheduler=with_scheduler)
+        elapsed = max(time.time() - started, 0.001)
+        worker.refresh()  # rq keeps the job counters in redis
+        jobs = worker.successful_job_count + worker.failed_job_count
+        app.logger.info('worker %d (pid %d) exiting: %d jobs done, %d failed, '
+                        '%.2f jobs/s over %.0fs (%.1fs spent working)',
+                        slot, os.getpid(), worker.successful_job_count,
+                        worker.failed_job_count, jobs / elapsed, elapsed,
+                        worker.total_working_time)
+
+
+def _spawn(slot, queue_name, max_jobs, fork_after_import, with_scheduler):
+    # connections must not be shared across processes, so the parent closes any it has open before forking - the child
+    # then starts without any, and both sides open new ones on first use. (closing them in the child instead would
+    # close the parent's sockets along with them)
+    db.engine.dispose()
+    current_app.redis.connection_pool.disconnect()
+    pid = os.fork()
+    if pid:
+        return pid
+    # we're the child from here on. never return into the parent's code, always exit
+    # leaving the parent's process group means a ctrl-c in the terminal only reaches the parent, which passes it on once
+    os.setpgid(0, 0)
+    status = 0
+    try:
+        if fork_after_import:
+            # the parent already built the app, so we just borrow it
+            app = current_app._get_current_object()
+        else:
+            app = create_app()
+        # only the first worker runs the scheduler, one is enough
+        _work(app, slot, queue_name, max_jobs, with_scheduler and slot == 0)
+    except Exception:
+        logging.exception('worker %d crashed', slot)
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def run_workers(processes, queue_name='microblog-tasks', max_jobs=None,
+                fork_after_import=True, with_scheduler=False):
+    if fork_after_import:
+        # load the tasks (and everything they import) before forking, so the children share those memory pages
+        importlib.import_module('app.tasks')
+
+    children = {}
+    stopping = []
+
+    def stop(signum, frame):
+        # first signal asks the workers to finish their current job (rq's warm shutdown), a second one makes them quit now
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(processes):
+        children[_spawn(slot, queue_name, max_jobs, fork_after_import, with_scheduler)] = slot
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        # a worker exits on its own after max_jobs jobs (or if it crashed) - start a fresh one in its place
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            current_app.logger.info('worker %d (pid %d) finished, restarting it', slot, pid)
+        else:
+            current_app.logger.warning('worker %d (pid %d) died with status %d, restarting it', slot, pid, status)
+            time.sleep(1)  # don't spin if something is badly broken
+        children[_spawn(slot, queue_name, max_jobs, fork_after_import, with_scheduler)] = slot
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# what the api token cache (see app/token_cache.py) saves per request. the requests are conditional GETs answered
+# with a 304, so authentication is most of the work. requests go through flask's test client, without a web server
+#
+# by default it uses a throwaway sqlite file - point DATABASE_URL at mysql/postgres to include a network round trip.
+# the 'redis' run needs a running redis
+#   REDIS_URL=redis://localhost:6379/15 python benchmarks/api_auth.py --requests 2000
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+def run(backend, args, database_url):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        TOKEN_CACHE_BACKEND = backend
+        ELASTICSEARCH_URL = None
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        user = User.query.filter_by(username='bench').first()
+        token = user.get_token(expires_in=24 * 3600)
+        db.session.commit()
+        url = '/api/users/{}'.format(user.id)
+        queries = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: queries.append(1))
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + token}
+    headers['If-None-Match'] = client.get(url, headers=headers).headers['ETag']
+
+    del queries[:]
+    start = time.perf_counter()
+    for i in range(args.requests):
+        assert client.get(url, headers=headers).status_code == 304
+    elapsed = time.perf_counter() - start
+    print('{:>5}: {:6.3f} ms per request, {:4.1f} queries per request'.format(
+        backend, 1000 * elapsed / args.requests, len(queries) / args.requests))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app(type('BuildConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': database_url,
+                                                      'ELASTICSEARCH_URL': None}))
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(username='bench', email='bench@example.com'))
+        db.session.commit()
+
+    for backend in ['null', 'local', 'redis']:
+        run(backend, args, database_url)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# creating posts through the api one request at a time against POST /api/posts/bulk. requests go through flask's
+# test client, without a web server, and elasticsearch is left out
+#   python benchmarks/bulk_posts.py --posts 1000
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+BODIES = ['The quick brown fox jumps over the lazy dog, post number {}',
+          'Le renard brun rapide saute par-dessus le chien paresseux, message {}',
+          'Der schnelle braune Fuchs springt über den faulen Hund, Beitrag {}']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=1000)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+            'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        CACHE_BACKEND = 'local'
+        ELASTICSEARCH_URL = None
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench', email='bench@example.com')
+        db.session.add(user)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + user.get_token(expires_in=24 * 3600)}
+        db.session.commit()
+    client = app.test_client()
+    posts = [{'body': BODIES[i % len(BODIES)].format(i)} for i in range(args.posts)]
+
+    start = time.perf_counter()
+    for post in posts:
+        assert client.post('/api/posts', headers=headers, json=post).status_code == 201
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, len(posts), app.config['API_BULK_MAX']):
+        assert client.post('/api/posts/bulk', headers=headers,
+                           json=posts[i:i + app.config['API_BULK_MAX']]).status_code == 201
+    bulk = time.perf_counter() - start
+
+    print('one at a time: {:8.0f} posts per second'.format(args.posts / single))
+    print('         bulk: {:8.0f} posts per second'.format(args.posts / bulk))
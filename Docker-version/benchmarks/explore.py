@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# requests per second for the explore page with the post list cache (see app/cache.py) off and on
+# requests go through flask's test client, so this measures the app itself without any web server in front
+#
+# the 'redis' run needs a running redis (the db picked by REDIS_URL gets flushed!)
+#   REDIS_URL=redis://localhost:6379/15 python benchmarks/explore.py --requests 500
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+
+def run(backend, args, database_url):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        CACHE_BACKEND = backend
+        WTF_CSRF_ENABLED = False
+        ELASTICSEARCH_URL = None
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        if backend == 'redis':
+            app.redis.flushdb()
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+    pages = max(args.posts // app.config['POSTS_PER_PAGE'], 1)
+    start = time.perf_counter()
+    for i in range(args.requests):
+        response = client.get('/explore?page={}'.format(i % min(pages, args.pages) + 1))
+        assert response.status_code == 200
+    elapsed = time.perf_counter() - start
+    print('{:>5}: {:8.1f} requests/s'.format(backend, args.requests / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=3, help='how many different explore pages are requested')
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app(type('BuildConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': database_url,
+                                                      'ELASTICSEARCH_URL': None}))
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(args.users)]
+        for user in users:
+            user.set_password('cat')
+        db.session.add_all(users)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post number {}'.format(i), author=users[i % len(users)],
+                                 timestamp=now - timedelta(minutes=i)) for i in range(args.posts)])
+        db.session.commit()
+
+    for backend in ['null', 'local', 'redis']:
+        run(backend, args, database_url)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# compares the 'sql' and 'redis' notification backends (see app/notifications.py) with several threads
+# sending unread-count notifications at the same time, like a burst of private messages would
+#
+# needs a running redis. by default it uses a throwaway sqlite file, point DATABASE_URL at mysql/postgres for real numbers
+#   REDIS_URL=redis://localhost:6379/15 python benchmarks/notifications.py --senders 8 --per-sender 200
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+def run(backend, args, database_url):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        NOTIFICATION_BACKEND = backend
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                            for i in range(args.users)])
+        db.session.commit()
+        app.redis.flushdb()
+        user_ids = [u.id for u in User.query]
+
+    errors = []
+
+    def sender(n):
+        rnd = random.Random(n)
+        with app.app_context():
+            for i in range(args.per_sender):
+                try:
+                    user = User.query.get(rnd.choice(user_ids))
+                    user.add_notification('unread_message_count', i)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    errors.append(e)
+            db.session.remove()
+
+    threads = [threading.Thread(target=sender, args=(n,)) for n in range(args.senders)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    write_time = time.perf_counter() - start
+
+    with app.app_context():
+        users = User.query.all()
+        start = time.perf_counter()
+        for i in range(args.reads):
+            users[i % len(users)].get_notifications(0.0)
+        read_time = time.perf_counter() - start
+        duplicates = sum(max(len([n for n in u.get_notifications() if n['name'] == 'unread_message_count']) - 1, 0)
+                         for u in users)
+
+    sent = args.senders * args.per_sender
+    print('{:>6}: {:8.0f} notifications/s sent, {:6.3f} ms per read, {} errors, {} duplicate rows'.format(
+        backend, (sent - len(errors)) / write_time, 1000 * read_time / args.reads, len(errors), duplicates))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--per-sender', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--reads', type=int, default=2000)
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    for backend in ['sql', 'redis']:
+        run(backend, args, database_url)
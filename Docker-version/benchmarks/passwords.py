@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# how many password checks per second one core manages with different PASSWORD_HASH_METHOD settings, to help pick
+# the number of iterations. aim for a few tens of milliseconds per check on the production machines, and size
+# PASSWORD_HASH_WORKERS from the expected peak logins per second
+#   python benchmarks/passwords.py --checks 20 pbkdf2:sha256:150000 pbkdf2:sha256:260000 pbkdf2:sha512:150000
+import argparse
+import time
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checks', type=int, default=20)
+    parser.add_argument('methods', nargs='*', default=['pbkdf2:sha256:50000', 'pbkdf2:sha256:150000',
+                                                         'pbkdf2:sha256:260000', 'pbkdf2:sha512:150000'])
+    args = parser.parse_args()
+
+    for method in args.methods:
+        pwhash = generate_password_hash('correct horse battery staple', method)
+        start = time.perf_counter()
+        for i in range(args.checks):
+            assert check_password_hash(pwhash, 'correct horse battery staple')
+        elapsed = time.perf_counter() - start
+        print('{:>22}: {:7.2f} ms per check, {:6.1f} checks per second per core'.format(
+            method, 1000 * elapsed / args.checks, args.checks / elapsed))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# items per second for api pages of users and posts: the old way (url_for for every link, flask's jsonify, a query per
+# post for its next link) against app/serializers.py. only serialization is timed - the page of models is loaded once
+# up front. install orjson to see the difference it makes on top
+#   python benchmarks/serializers.py --items 100 --rounds 200
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from flask import jsonify, url_for
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db, serializers
+from app.models import User, Post
+from config import Config
+
+
+def old_user_dict(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'last_seen': user.last_seen.isoformat() + 'Z',
+        'about_me': user.about_me,
+        'post_count': user.post_count(),
+        'follower_count': user.follower_count(),
+        'followed_count': user.followed_count(),
+        '_links': {
+            'self': url_for('api.get_user', id=user.id),
+            'followers': url_for('api.get_followers', id=user.id),
+            'followed': url_for('api.get_followed', id=user.id),
+            'avatar': user.avatar(128)
+        }
+    }
+
+
+def old_post_dict(post):
+    data = {
+        'id': post.id,
+        'body': post.body,
+        'timestamp': post.timestamp,
+        'user_id': post.user_id,
+        'language': post.language,
+        '_links': {
+            'self': url_for('api.get_post', id=post.id)
+        }
+    }
+    if post.id-1 > 0:
+        data['_links']['previous'] = url_for('api.get_post', id=post.id-1)
+    if db.session.query(Post.id).filter_by(id=post.id + 1).first() is not None:
+        data['_links']['next'] = url_for('api.get_post', id=post.id+1)
+    return data
+
+
+def measure(name, items, rounds, serialize):
+    serialize(items)
+    start = time.perf_counter()
+    for i in range(rounds):
+        serialize(items).get_data()
+    elapsed = time.perf_counter() - start
+    print('{:>12}: {:9.0f} items per second'.format(name, rounds * len(items) / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        CACHE_BACKEND = 'local'
+        ELASTICSEARCH_URL = None
+
+    app = create_app(BenchConfig)
+    with app.test_request_context():
+        db.create_all()
+        author = User(username='bench', email='bench@example.com')
+        db.session.add(author)
+        db.session.add_all([User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                            for i in range(args.items)])
+        db.session.add_all([Post(body='post {}'.format(i), author=author) for i in range(args.items)])
+        db.session.commit()
+        users = User.query.limit(args.items).all()
+        posts = Post.query.limit(args.items).all()
+
+        print('orjson is {}installed'.format('' if serializers.orjson else 'not '))
+        measure('old users', users, args.rounds, lambda items: jsonify([old_user_dict(u) for u in items]))
+        measure('new users', users, args.rounds, lambda items: serializers.json_response(User.to_dicts(items)))
+        measure('old posts', posts, args.rounds, lambda items: jsonify([old_post_dict(p) for p in items]))
+        measure('new posts', posts, args.rounds, lambda items: serializers.json_response(Post.to_dicts(items)))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# compares home page timelines (see app/timeline.py) on a skewed follow graph, where a few accounts have most of
+# the followers:
+#   pull   - followed_posts() on every read, nothing written anywhere
+#   push   - every post pushed to every follower (hybrid with a threshold nobody reaches)
+#   hybrid - posts from accounts with more than --threshold followers are pulled and merged at read time
+# write amplification is the number of sorted set entries written per post
+#
+# needs a running redis (the db picked by REDIS_URL gets flushed!). by default it uses a throwaway sqlite file
+#   REDIS_URL=redis://localhost:6379/15 python benchmarks/timelines.py --users 2000 --threshold 100
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db
+from app.models import User, Post, followers
+from app.timeline import followed_posts_page
+from config import Config
+
+
+def build(app, args):
+    # user n is followed by about users / (n + 1) others - a handful of big accounts and a long tail of small ones
+    rnd = random.Random(1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)} for i in range(args.users)])
+        ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+        rows = set()
+        for n, followed in enumerate(ids):
+            for follower in rnd.sample(ids, min(args.users // (n + 1) + 1, args.users)):
+                if follower != followed:
+                    rows.add((follower, followed))
+        db.session.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in rows])
+        db.session.commit()
+        return ids, len(rows)
+
+
+def zadds(app):
+    stats = app.redis.info('commandstats')
+    return stats.get('cmdstat_zadd', {}).get('calls', 0)
+
+
+def run(mode, threshold, args, database_url):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        TIMELINE_MODE = 'pull' if mode == 'pull' else 'hybrid'
+        TIMELINE_FANOUT_THRESHOLD = threshold
+
+    app = create_app(BenchConfig)
+    rnd = random.Random(2)
+    with app.app_context():
+        app.redis.flushdb()
+        db.session.query(Post).delete()
+        db.session.commit()
+        users = User.query.all()
+        # every timeline gets read once first, otherwise pushes to timelines that don't exist yet are skipped
+        for user in users:
+            followed_posts_page(user, 1, args.per_page)
+
+        app.redis.config_resetstat()
+        now = datetime.utcnow()
+        start = time.perf_counter()
+        for i in range(args.posts):
+            # bigger accounts post more often too
+            author = users[min(int(rnd.paretovariate(1)) - 1, len(users) - 1)]
+            db.session.add(Post(body='post {}'.format(i), author=author, timestamp=now + timedelta(seconds=i)))
+            db.session.commit()
+        write_time = time.perf_counter() - start
+        written = zadds(app)
+
+        readers = [rnd.choice(users) for i in range(args.reads)]
+        start = time.perf_counter()
+        for user in readers:
+            posts = followed_posts_page(user, 1, args.per_page)
+            if posts is None:
+                user.followed_posts().paginate(1, args.per_page, False).items
+        read_time = time.perf_counter() - start
+        db.session.remove()
+
+    print('{:>6} (threshold {:>7}): {:8.1f} entries written per post, {:6.2f} ms per post, {:6.2f} ms per read'.format(
+        mode, threshold, written / args.posts, 1000 * write_time / args.posts, 1000 * read_time / args.reads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--threshold', type=int, default=50)
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app(type('BuildConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': database_url}))
+    ids, follows = build(app, args)
+    print('{} users, {} follows'.format(len(ids), follows))
+    run('pull', 0, args, database_url)
+    run('push', args.users, args, database_url)
+    run('hybrid', args.threshold, args, database_url)
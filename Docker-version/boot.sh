@@ -10,4 +10,11 @@ while true; do
     sleep 5
 done
 flask translate compile
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
+# threaded workers (gthread): an open /notifications/stream keeps one thread busy for up to NOTIFICATION_STREAM_TIMEOUT
+# seconds, but only a thread - the rest of the site keeps being served by the others. a sleeping thread waiting on redis
+# costs little more than its stack, so size GUNICORN_THREADS for the number of open tabs you expect per worker, plus
+# some for normal requests. (gevent would make idle streams even cheaper, but it would also turn the password hashing
+# pool in app/passwords.py into greenlets that block everything while they hash)
+exec gunicorn -b :5000 --worker-class gthread \
+    --workers ${GUNICORN_WORKERS:-2} --threads ${GUNICORN_THREADS:-50} \
+    --access-logfile - --error-logfile - microblog:app
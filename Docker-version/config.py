@@ -27,4 +27,97 @@ class Config(object):
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
 
     #redis
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+
+    # exports - where finished export files are written, and how many posts are read from the db at a time
+    EXPORT_FOLDER = os.environ.get('EXPORT_FOLDER') or os.path.join(basedir, 'exports')
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 1000)
+
+    # background task progress is only written out when it moves by this many percent, or after this many seconds
+    TASK_PROGRESS_MIN_DELTA = int(os.environ.get('TASK_PROGRESS_MIN_DELTA') or 5)
+    TASK_PROGRESS_MIN_INTERVAL = float(os.environ.get('TASK_PROGRESS_MIN_INTERVAL') or 2)
+
+    # the same task with the same arguments can only be queued once per user, for up to TASK_DEDUP_TTL seconds
+    # and each user / each task type can only have so many tasks queued or running at once (0 = no limit)
+    TASK_DEDUP_TTL = int(os.environ.get('TASK_DEDUP_TTL') or 3600)
+    MAX_TASKS_PER_USER = int(os.environ.get('MAX_TASKS_PER_USER') or 2)
+    MAX_TASKS_PER_TYPE = int(os.environ.get('MAX_TASKS_PER_TYPE') or 20)
+
+    # notification stream - a keep-alive is sent after this many idle seconds, and the stream is closed
+    # (and reopened by the browser) after NOTIFICATION_STREAM_TIMEOUT so it doesn't tie up a server thread forever
+    # each open stream holds a thread the whole time, so run a threaded server with plenty of threads (see boot.sh) -
+    # with a single sync worker one open tab would block the whole site
+    NOTIFICATION_HEARTBEAT = int(os.environ.get('NOTIFICATION_HEARTBEAT') or 15)
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+
+    # where notifications are kept: 'sql' (Notification rows) or 'redis' (a hash and sorted set per user, kept for NOTIFICATION_TTL seconds)
+    NOTIFICATION_BACKEND = os.environ.get('NOTIFICATION_BACKEND') or 'sql'
+    NOTIFICATION_TTL = int(os.environ.get('NOTIFICATION_TTL') or 7 * 24 * 3600)
+
+    # outgoing email queue - how many sender threads, how many emails can wait (callers block up to MAIL_QUEUE_TIMEOUT
+    # seconds when it's full), how many go through one smtp connection, and how transient smtp errors are retried
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
+    MAIL_RETRY_DELAY = float(os.environ.get('MAIL_RETRY_DELAY') or 1)
+
+    # digest emails - sent every DIGEST_INTERVAL seconds, skipping the last DIGEST_LAG seconds which may still be changing
+    DIGEST_INTERVAL = int(os.environ.get('DIGEST_INTERVAL') or 24 * 3600)
+    DIGEST_LAG = int(os.environ.get('DIGEST_LAG') or 30)
+
+    # how many followers a broadcast message is written to per transaction
+    BROADCAST_CHUNK_SIZE = int(os.environ.get('BROADCAST_CHUNK_SIZE') or 500)
+
+    # follow graph cache: 'redis' (shared by all processes) or 'local' (per process, at most FOLLOW_CACHE_SIZE users)
+    # cached sets are reloaded from the db after FOLLOW_CACHE_TTL seconds. 'local' only sees follows made in its own
+    # process - the others show the old state until their copy expires, so only pick it when running a single process
+    FOLLOW_CACHE_BACKEND = os.environ.get('FOLLOW_CACHE_BACKEND') or 'redis'
+    FOLLOW_CACHE_SIZE = int(os.environ.get('FOLLOW_CACHE_SIZE') or 10000)
+    FOLLOW_CACHE_TTL = int(os.environ.get('FOLLOW_CACHE_TTL') or 300)
+
+    # home page timelines: 'pull' reads them from the db every time, 'hybrid' keeps them in redis (see app/timeline.py)
+    # authors with more than TIMELINE_FANOUT_THRESHOLD followers have their posts merged in when read instead of
+    # written to every follower. timelines hold the newest TIMELINE_LENGTH posts and expire after TIMELINE_TTL idle seconds
+    TIMELINE_MODE = os.environ.get('TIMELINE_MODE') or 'pull'
+    TIMELINE_FANOUT_THRESHOLD = int(os.environ.get('TIMELINE_FANOUT_THRESHOLD') or 1000)
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 200)
+    TIMELINE_TTL = int(os.environ.get('TIMELINE_TTL') or 7 * 24 * 3600)
+
+    # cache (see app/cache.py): 'redis' (a local LRU in front of redis), 'local' (just the LRU) or 'null' (off)
+    # entries live CACHE_DEFAULT_TIMEOUT seconds, but only up to CACHE_LOCAL_TTL in the local tier, which is how
+    # long changes made by other processes can take to show up there
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'redis'
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT') or 300)
+    CACHE_LOCAL_SIZE = int(os.environ.get('CACHE_LOCAL_SIZE') or 1000)
+    CACHE_LOCAL_TTL = int(os.environ.get('CACHE_LOCAL_TTL') or 5)
+
+    # how often (in seconds) a user's last_seen time gets written while they're clicking around
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or 60)
+
+    # api token cache: 'redis' (shared by all processes), 'local' or 'null' (off)
+    # 'local' saves a round trip to redis but is per process (at most TOKEN_CACHE_SIZE tokens) - a token revoked in one
+    # process keeps working in the others for up to TOKEN_CACHE_TTL seconds, so only pick it when running a single process
+    TOKEN_CACHE_BACKEND = os.environ.get('TOKEN_CACHE_BACKEND') or 'redis'
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+
+    # password hashing (see app/passwords.py) - werkzeug method string and salt length. hashes made with other
+    # settings are upgraded when their owner next logs in. hashing runs on PASSWORD_HASH_WORKERS threads, with up to
+    # PASSWORD_HASH_QUEUE more waiting for at most PASSWORD_HASH_TIMEOUT seconds before the request gets a 503
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 8)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 2)
+
+    # most resources the api hands out for one ?ids= batch read (see app/api/batch.py)
+    API_BATCH_MAX = int(os.environ.get('API_BATCH_MAX') or 100)
+    # most posts one POST /api/posts/bulk can create
+    API_BULK_MAX = int(os.environ.get('API_BULK_MAX') or 1000)
+
+    # the change log behind /api/changes (see app/changes.py). consumers can wait up to CHANGE_LOG_MAX_WAIT seconds for
+    # new changes. a gap in the log is given CHANGE_LOG_SETTLE seconds to fill before anything after it is handed out
+    CHANGE_LOG_MAX_WAIT = int(os.environ.get('CHANGE_LOG_MAX_WAIT') or 30)
+    CHANGE_LOG_SETTLE = float(os.environ.get('CHANGE_LOG_SETTLE') or 2)
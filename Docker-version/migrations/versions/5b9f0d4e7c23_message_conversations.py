@@ -0,0 +1,54 @@
+"""message conversations
+
+Revision ID: 5b9f0d4e7c23
+Revises: c41d7e08a2b5
+Create Date: 2026-10-19 12:26:03.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b9f0d4e7c23'
+down_revision = 'c41d7e08a2b5'
+branch_labels = None
+depends_on = None
+
+# how many existing messages are updated per round trip while backfilling
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column('message', sa.Column('conversation', sa.String(length=32), nullable=True))
+
+    # fill in the conversation of the existing messages, a batch at a time (walking the primary key)
+    # so a big table is never loaded or locked all at once
+    message = sa.table('message', sa.column('id', sa.Integer),
+                       sa.column('sender_id', sa.Integer),
+                       sa.column('recipient_id', sa.Integer),
+                       sa.column('conversation', sa.String))
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([message.c.id, message.c.sender_id, message.c.recipient_id])
+            .where(message.c.id > last_id).order_by(message.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        updates = [{'message_id': id, 'key': '{}:{}'.format(*sorted([sender_id, recipient_id]))}
+                   for id, sender_id, recipient_id in rows if sender_id and recipient_id]
+        if updates:
+            conn.execute(message.update().where(message.c.id == sa.bindparam('message_id'))
+                         .values(conversation=sa.bindparam('key')), updates)
+        last_id = rows[-1][0]
+
+    # the indexes go on after the backfill, that's quicker than keeping them up to date while it runs
+    op.create_index('ix_message_conversation_timestamp', 'message', ['conversation', 'timestamp'], unique=False)
+    op.create_index('ix_message_recipient_id_timestamp', 'message', ['recipient_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_message_conversation_timestamp', table_name='message')
+    op.drop_column('message', 'conversation')
@@ -1,14 +1,38 @@
 #!/usr/bin/env python
 from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import shutil
+import signal
+import smtplib
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import redis
+from flask_mail import Message as MailMessage
+from app import create_app, db, mail
+from app.email import send_email
+from app.models import User, Post, Message, Notification, Task, Change, followers
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    CACHE_BACKEND = 'local'
+    FOLLOW_CACHE_BACKEND = 'local'
+    TOKEN_CACHE_BACKEND = 'local'
+    # tests that need redis flush this database, so keep it away from anything else
+    REDIS_URL = os.environ.get('TEST_REDIS_URL') or 'redis://localhost:6379/15'
+
+
+def redis_available():
+    try:
+        return redis.Redis.from_url(TestConfig.REDIS_URL).ping()
+    except redis.exceptions.RedisError:
+        return False
 
 
 class UserModelCase(unittest.TestCase):
@@ -29,6 +53,23 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan')
+        u.set_password('cat')
+        old_hash = u.password_hash
+        self.assertTrue(old_hash.startswith('pbkdf2:sha256:1000$'))
+
+        # a failed login leaves the old hash alone, a successful one upgrades it
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.check_password('dog'))
+        self.assertEqual(u.password_hash, old_hash)
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        new_hash = u.password_hash
+        self.assertTrue(u.check_password('cat'))
+        self.assertEqual(u.password_hash, new_hash)
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
@@ -58,6 +99,63 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        self.assertEqual(u1.is_following_many([u2.id, u3.id]), set())
+        self.assertEqual(self.app.follow_cache.get(u1.id), set())
+
+        # the cached set is updated once the follow is committed, without going back to the db
+        u1.follow(u2)
+        self.assertTrue(u1.is_following(u2))
+        self.assertEqual(self.app.follow_cache.get(u1.id), set())
+        db.session.commit()
+        self.assertEqual(self.app.follow_cache.get(u1.id), {u2.id})
+        self.assertEqual(u1.is_following_many([u2.id, u3.id]), {u2.id})
+
+        # and a rolled back follow never reaches it
+        u1.follow(u3)
+        db.session.rollback()
+        self.assertFalse(u1.is_following(u3))
+        self.assertEqual(self.app.follow_cache.get(u1.id), {u2.id})
+
+    @unittest.skipUnless(redis_available(), 'needs a redis server (set TEST_REDIS_URL)')
+    def test_shared_follow_cache(self):
+        from app.follow_cache import RedisFollowCache
+        self.app.follow_cache = RedisFollowCache(self.app.redis, self.app.config['FOLLOW_CACHE_TTL'])
+        self.app.redis.flushdb()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertFalse(u1.is_following(u2))
+
+        # another process reads the same set, which the follow updates once it's committed
+        other = RedisFollowCache(redis.Redis.from_url(TestConfig.REDIS_URL), self.app.config['FOLLOW_CACHE_TTL'])
+        self.assertEqual(other.get(u1.id), set())
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(other.get(u1.id), {u2.id})
+        self.app.redis.flushdb()
+
+    def test_stale_follow_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+
+        # as another process would see it: u1 follows u3 but not u2. writes go by the db regardless
+        self.app.follow_cache.set(u1.id, {u3.id})
+        u1.follow(u2)
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.followed.all(), [u2])
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -96,6 +194,966 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_notifications(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        first = u.get_notifications()
+        self.assertEqual([(n['name'], n['data']) for n in first],
+                         [('unread_message_count', 1)])
+
+        # a newer notification with the same name replaces the old one
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual([n['data'] for n in u.get_notifications()], [2])
+        self.assertEqual(
+            [n['data'] for n in u.get_notifications(first[0]['timestamp'])], [2])
+
+    def query_plan(self, query):
+        # sqlite's own description of how it will run the query, one line per step
+        sql = str(query.statement.compile(dialect=db.engine.dialect,
+                                          compile_kwargs={'literal_binds': True}))
+        return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+    def test_query_plans(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        queries = {
+            'followed_posts': u1.followed_posts(),
+            'is_following': u1.followed.filter(followers.c.followed_id == u2.id),
+            'followers': u1.followers,
+            'new_messages': Message.query.filter_by(recipient=u1).filter(
+                Message.timestamp > datetime(1900, 1, 1)),
+            'notifications': u1.notifications.filter(Notification.timestamp > 0),
+            'notification_by_name': u1.notifications.filter_by(name='task_progress'),
+            'tasks_in_progress': Task.query.filter_by(user=u1, complete=False),
+            'user_posts': u1.posts.order_by(Post.timestamp.desc()),
+        }
+        for name, query in queries.items():
+            plan = self.query_plan(query)
+            # a plain "SCAN <table>" means reading the whole table
+            scans = [step for step in plan if step.split(' ')[:2] in (
+                ['SCAN', 'post'], ['SCAN', 'followers'], ['SCAN', 'message'],
+                ['SCAN', 'notification'], ['SCAN', 'task'], ['SCAN', 'user'])
+                and 'INDEX' not in step]
+            self.assertEqual(scans, [], name)
+            self.assertTrue(any('INDEX' in step for step in plan), name)
+
+    def test_conversation_pages(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        now = datetime.utcnow()
+        messages = [Message(author=u1 if i % 2 else u2,
+                            recipient=u2 if i % 2 else u1, body=str(i),
+                            timestamp=now + timedelta(seconds=i // 2))
+                    for i in range(5)]
+        db.session.add_all(messages + [
+            Message(author=u3, recipient=u1, body='other')])
+        db.session.commit()
+        key = Message.conversation_key(u2.id, u1.id)
+        self.assertEqual(set(m.conversation for m in messages), {key})
+
+        # newest first, two at a time, including messages sharing a timestamp
+        page, has_older, has_newer = Message.conversation_page(key, 2)
+        self.assertEqual([m.body for m in page], ['4', '3'])
+        self.assertTrue(has_older)
+        self.assertFalse(has_newer)
+        page, has_older, has_newer = Message.conversation_page(
+            key, 2, before=page[-1].cursor())
+        self.assertEqual([m.body for m in page], ['2', '1'])
+        self.assertTrue(has_newer)
+        page, has_older, has_newer = Message.conversation_page(
+            key, 2, before=page[-1].cursor())
+        self.assertEqual([m.body for m in page], ['0'])
+        self.assertFalse(has_older)
+        page, has_older, has_newer = Message.conversation_page(
+            key, 2, after=page[0].cursor())
+        self.assertEqual([m.body for m in page], ['2', '1'])
+        self.assertTrue(has_newer)
+
+
+class FakePubSub(object):
+    # hands out the given messages, then nothing - waiting out the timeout like the real one would
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.closed = False
+
+    def get_message(self, timeout=0):
+        if self.messages:
+            return self.messages.pop(0)
+        time.sleep(timeout)
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class NotificationStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_stream(self):
+        from app.notifications import stream
+        pubsub = FakePubSub([
+            {'type': 'subscribe', 'data': 1},
+            # already replayed from the db, so not sent again
+            {'type': 'message', 'data': json.dumps({'name': 'a', 'timestamp': 1.0})},
+            {'type': 'message', 'data': json.dumps({'name': 'b', 'timestamp': 2.0})}])
+        start = time.time()
+        events = list(stream(pubsub, [{'name': 'a', 'timestamp': 1.0}], 0.02, 0.1))
+        # the stream ends by itself after the timeout, and lets go of its subscription
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(pubsub.closed)
+        self.assertEqual(events[0], 'retry: 20.0\n\n')
+        self.assertEqual([e.split('\n')[0] for e in events[1:3]], ['id: 1.0', 'id: 2.0'])
+        # and idles with keep-alives in between
+        self.assertTrue(events[3:])
+        self.assertEqual(set(events[3:]), {': keep-alive\n\n'})
+
+    def test_stream_without_redis(self):
+        self.app.redis = redis.Redis(port=1)
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        # 204 tells the browser to stop reconnecting and fall back to polling
+        self.assertEqual(client.get('/notifications/stream').status_code, 204)
+
+
+class TaskCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['EXPORT_FOLDER'] = tempfile.mkdtemp()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.app.config['EXPORT_FOLDER'])
+
+    def test_export_posts(self):
+        from app.tasks import export_posts
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([
+            Post(body='first', author=u, timestamp=now),
+            Post(body='second', author=u, timestamp=now + timedelta(seconds=1))])
+        db.session.commit()
+
+        export_posts(u.id)
+        path = os.path.join(self.app.config['EXPORT_FOLDER'],
+                            'user-{}.jsonl.gz'.format(u.id))
+        with gzip.open(path, 'rt') as f:
+            posts = [json.loads(line) for line in f]
+        self.assertEqual([p['body'] for p in posts], ['first', 'second'])
+        self.assertEqual(posts[0]['timestamp'], now.isoformat() + 'Z')
+
+    def test_progress_reporting(self):
+        from app import tasks
+        # writes are throttled, and completion is reported exactly once
+        tasks._reported_progress.clear()
+        self.assertTrue(tasks._should_report_progress('job', 0, 0))
+        tasks._reported_progress['job'] = (0, 0)
+        self.assertFalse(tasks._should_report_progress('job', 1, 1))
+        self.assertTrue(tasks._should_report_progress('job', 5, 1))
+        self.assertTrue(tasks._should_report_progress('job', 1, 2))
+        self.assertTrue(tasks._should_report_progress('job', 100, 1))
+        tasks._reported_progress['job'] = (100, 1)
+        self.assertFalse(tasks._should_report_progress('job', 100, 5))
+        tasks._reported_progress.clear()
+
+        # export_posts only reports 100% (which commits) once the posts cursor is done with and the file is in place
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body=str(i), author=u) for i in range(3)])
+        db.session.commit()
+        path = os.path.join(self.app.config['EXPORT_FOLDER'], 'user-{}.jsonl.gz'.format(u.id))
+        reported = []
+        set_task_progress = tasks._set_task_progress
+        tasks._set_task_progress = lambda progress: reported.append((progress, os.path.exists(path)))
+        try:
+            tasks.export_posts(u.id)
+        finally:
+            tasks._set_task_progress = set_task_progress
+        self.assertEqual(reported, [(0, False), (33, False), (66, False), (99, False), (100, True)])
+
+    def test_download_export(self):
+        from app.tasks import export_posts
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        u2.set_password('dog')
+        db.session.add_all([u1, u2, Post(body='first', author=u1)])
+        db.session.commit()
+        export_posts(u1.id)
+        path = os.path.join(self.app.config['EXPORT_FOLDER'], 'user-{}.jsonl.gz'.format(u1.id))
+        db.session.add(Task(id='export-1', name='export_posts', user=u1, complete=True, artifact_path=path))
+        db.session.commit()
+
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/export_posts/export-1/download')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(gzip.decompress(response.data))['body'], 'first')
+        # resumable - a range request gets just the rest of the file
+        response = client.get('/export_posts/export-1/download', headers={'Range': 'bytes=10-'})
+        self.assertEqual(response.status_code, 206)
+
+        # nobody else gets to see it
+        client.get('/auth/logout')
+        client.post('/auth/login', data={'username': 'susan', 'password': 'dog'})
+        self.assertEqual(client.get('/export_posts/export-1/download').status_code, 404)
+
+    def test_send_digests(self):
+        from app.tasks import send_digests
+        self.app.config['DIGEST_LAG'] = 0
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u2.follow(u1)
+        db.session.commit()
+        # the first run only sets the starting point
+        with mail.record_messages() as outbox:
+            send_digests(reschedule=False)
+        self.assertEqual(outbox, [])
+
+        u3.follow(u1)
+        db.session.add_all([Message(author=u2, recipient=u1, body='hi'),
+                            Message(author=u2, recipient=u1, body='again'),
+                            Message(author=u1, recipient=u3, body='hey')])
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            send_digests(reschedule=False)
+        emails = {m.recipients[0]: m.body for m in outbox}
+        self.assertEqual(sorted(emails), ['john@example.com', 'mary@example.com'])
+        self.assertIn('New followers: mary', emails['john@example.com'])
+        self.assertIn('2 from susan', emails['john@example.com'])
+        self.assertIn('1 from john', emails['mary@example.com'])
+
+        # nothing new, nothing sent
+        with mail.record_messages() as outbox:
+            send_digests(reschedule=False)
+        self.assertEqual(outbox, [])
+
+    def test_broadcast_message(self):
+        from app.tasks import broadcast_message
+        self.app.config['BROADCAST_CHUNK_SIZE'] = 2
+        u1 = User(username='john', email='john@example.com')
+        others = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                  for i in range(5)]
+        db.session.add_all([u1] + others)
+        for u in others[:4]:
+            u.follow(u1)
+        db.session.add(Message(author=others[0], recipient=others[1], body='earlier'))
+        db.session.commit()
+
+        broadcast_message(u1.id, 'hello everyone')
+        self.assertEqual(Message.query.filter_by(sender_id=u1.id).count(), 4)
+        self.assertEqual(others[4].messages_received.count(), 0)
+        self.assertEqual(others[0].new_messages(), 1)
+        self.assertEqual(others[1].new_messages(), 2)
+        messages, older, newer = Message.conversation_page(
+            Message.conversation_key(u1.id, others[1].id), 10)
+        self.assertEqual([m.body for m in messages], ['hello everyone'])
+        data = {n['data'] for n in others[1].get_notifications()
+                if n['name'] == 'unread_message_count'}
+        self.assertEqual(data, {2})
+
+
+@unittest.skipUnless(redis_available(), 'needs a redis server (set TEST_REDIS_URL)')
+class TaskLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.redis.flushdb()
+        self.u = User(username='john', email='john@example.com')
+        self.u.set_password('cat')
+        db.session.add(self.u)
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.redis.flushdb()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def launch(self, name, *args):
+        job = self.u.launch_task(name, name, *args)
+        db.session.commit()
+        return job
+
+    def test_duplicates_and_limits(self):
+        self.app.config['MAX_TASKS_PER_USER'] = 2
+        self.app.config['MAX_TASKS_PER_TYPE'] = 2
+        job = self.launch('export_posts')
+        # asking again while it's pending hands back the same job rather than queueing another
+        self.assertEqual(self.launch('export_posts').get_id(), job.get_id())
+        self.assertEqual(Task.query.count(), 1)
+
+        # different arguments are a different task, up to the per user limit
+        self.assertIsNotNone(self.launch('broadcast_message', 'hello'))
+        self.assertIsNone(self.launch('broadcast_message', 'again'))
+
+        # and other users share the per type limit
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u2, u3])
+        db.session.commit()
+        self.assertIsNotNone(u2.launch_task('export_posts', 'exporting'))
+        self.assertIsNotNone(u2.launch_task('broadcast_message', 'broadcast', 'hi'))
+        self.assertIsNone(u3.launch_task('broadcast_message', 'broadcast', 'hi'))
+
+    def test_slot_released_on_completion(self):
+        from app import tasks
+        job = self.launch('export_posts')
+        get_current_job = tasks.get_current_job
+        tasks.get_current_job = lambda: job
+        try:
+            tasks._reported_progress.clear()
+            tasks._set_task_progress(100)
+        finally:
+            tasks.get_current_job = get_current_job
+        self.assertTrue(Task.query.get(job.get_id()).complete)
+        again = self.launch('export_posts')
+        self.assertIsNotNone(again)
+        self.assertNotEqual(again.get_id(), job.get_id())
+
+    def test_slot_released_on_cancel(self):
+        job = self.launch('export_posts')
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        client.get('/cancel_export')
+        again = self.launch('export_posts')
+        self.assertIsNotNone(again)
+        self.assertNotEqual(again.get_id(), job.get_id())
+
+
+class WorkerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_supervisor(self):
+        from app import worker
+        spawned = []
+        killed = []
+        handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+        def spawn(slot, *args):
+            spawned.append(slot)
+            return 100 + len(spawned)
+
+        def stop_and_exit(pid):
+            def exit():
+                signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+                return pid, 0
+            return exit
+        # worker 1 is done with its max_jobs, worker 2 crashes, then we're told to stop and both exit
+        exits = iter([lambda: (101, 0), lambda: (102, 1 << 8), stop_and_exit(103), lambda: (104, 0)])
+        patched = [(worker, '_spawn', spawn), (worker.time, 'sleep', lambda seconds: None),
+                   (os, 'wait', lambda: next(exits)()), (os, 'kill', lambda pid, sig: killed.append((pid, sig)))]
+        originals = [(obj, name, getattr(obj, name)) for obj, name, _ in patched]
+        try:
+            for obj, name, value in patched:
+                setattr(obj, name, value)
+            with self.assertLogs(self.app.logger, 'INFO') as logs:
+                worker.run_workers(2, fork_after_import=False)
+        finally:
+            for obj, name, value in originals:
+                setattr(obj, name, value)
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+
+        # each exit before the stop gets its slot a fresh worker, none after it
+        self.assertEqual(spawned, [0, 1, 0, 1])
+        # the stop is passed on to the workers running at the time, once each
+        self.assertEqual(killed, [(103, signal.SIGTERM), (104, signal.SIGTERM)])
+        self.assertIn('finished, restarting', logs.output[0])
+        self.assertIn('died with status 256', logs.output[1])
+
+    @unittest.skipUnless(redis_available(), 'needs a redis server (set TEST_REDIS_URL)')
+    def test_worker_exit_statistics(self):
+        from app import worker
+        self.app.redis.flushdb()
+        for i in range(3):
+            self.app.task_queue.enqueue('os.getpid')
+        with self.assertLogs(self.app.logger, 'INFO') as logs:
+            worker._work(self.app, 0, self.app.task_queue.name, 2, False)
+        self.assertIn('2 jobs done, 0 failed', logs.output[-1])
+        # max_jobs stops the worker with the third job still waiting
+        self.assertEqual(len(self.app.task_queue), 1)
+        self.app.redis.flushdb()
+
+
+@unittest.skipUnless(redis_available(), 'needs a redis server (set TEST_REDIS_URL)')
+class TimelineCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['TIMELINE_MODE'] = 'hybrid'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.redis.flushdb()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        self.u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.u1, self.u2, self.u3])
+        db.session.commit()
+        self.now = datetime.utcnow()
+
+    def tearDown(self):
+        self.app.redis.flushdb()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, author, seconds):
+        post = Post(body='post from {}'.format(author.username), author=author,
+                    timestamp=self.now + timedelta(seconds=seconds))
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+    def test_push(self):
+        from app import timeline
+        self.u1.follow(self.u2)
+        db.session.commit()
+        p1 = self.post(self.u2, 1)
+        # nobody has read a timeline yet, so there's nothing to push into
+        self.assertFalse(self.app.redis.exists(timeline.timeline_key(self.u1.id)))
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 10), [p1])
+
+        # once it's there, new posts are added to it - by followed authors and the user's own
+        p2 = self.post(self.u2, 2)
+        p3 = self.post(self.u1, 3)
+        self.post(self.u3, 4)
+        self.assertEqual([int(id) for id in self.app.redis.zrevrange(timeline.timeline_key(self.u1.id), 0, -1)],
+                         [p3, p2, p1, int(timeline.EMPTY)])
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 10), [p3, p2, p1])
+        self.assertEqual(timeline.followed_post_ids(self.u1, 1, 1), [p2])
+
+    def test_pull(self):
+        from app import timeline
+        self.app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        self.u1.follow(self.u2)
+        self.u1.follow(self.u3)
+        self.u2.follow(self.u3)
+        db.session.commit()
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 10), [])
+
+        # mary has two followers, so her posts only go to her own list and get merged in when john reads
+        p1 = self.post(self.u3, 1)
+        p2 = self.post(self.u2, 2)
+        p3 = self.post(self.u3, 3)
+        self.assertEqual(self.app.redis.smembers(timeline.PULLED_KEY), {str(self.u3.id).encode()})
+        self.assertEqual([int(id) for id in self.app.redis.zrevrange(timeline.timeline_key(self.u1.id), 0, -1)],
+                         [p2, int(timeline.EMPTY)])
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 10), [p3, p2, p1])
+
+        # a missing list of recent posts is rebuilt from the db
+        self.app.redis.delete(timeline.recent_key(self.u3.id))
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 2), [p3, p2])
+
+    def test_rebuild(self):
+        from app import timeline
+        self.app.config['TIMELINE_LENGTH'] = 3
+        self.u1.follow(self.u2)
+        db.session.commit()
+        ids = [self.post(self.u2, i) for i in range(4)]
+        self.app.redis.flushdb()
+        # rebuilt from followed_posts(), newest first and only as many as a timeline holds
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 3), ids[:0:-1])
+        self.assertIsNone(timeline.followed_post_ids(self.u1, 2, 2))
+
+        # following someone throws the timeline away, and the next read picks up their posts
+        p5 = self.post(self.u3, 5)
+        self.u1.follow(self.u3)
+        db.session.commit()
+        self.assertFalse(self.app.redis.exists(timeline.timeline_key(self.u1.id)))
+        self.assertEqual(timeline.followed_post_ids(self.u1, 0, 2), [p5, ids[3]])
+        posts, has_next = timeline.followed_posts_page(self.u1, 1, 2)
+        self.assertEqual(posts, self.u1.followed_posts().limit(2).all())
+        self.assertTrue(has_next)
+
+    def test_post_during_rebuild(self):
+        from app import timeline
+        self.u1.follow(self.u2)
+        db.session.commit()
+        p1 = self.post(self.u2, 1)
+        latest = timeline._latest
+        added = []
+
+        def read_then_post(query):
+            # a post committed after the db was read, but before the rebuilt timeline is written
+            entries = latest(query)
+            added.append(self.post(self.u2, 2))
+            return entries
+
+        timeline._latest = read_then_post
+        try:
+            ids = timeline.followed_post_ids(self.u1, 0, 10)
+        finally:
+            timeline._latest = latest
+        self.assertEqual(ids, [added[0], p1])
+        self.assertFalse(self.app.redis.exists(timeline.building_key(timeline.timeline_key(self.u1.id))))
+
+
+class CacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_tags(self):
+        cache = self.app.cache
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_set('a', compute, ['user:1']), 1)
+        self.assertEqual(cache.get_or_set('a', compute, ['user:1']), 1)
+        cache.invalidate('user:2')
+        self.assertEqual(cache.get_or_set('a', compute, ['user:1']), 1)
+        cache.invalidate('user:1')
+        self.assertEqual(cache.get_or_set('a', compute, ['user:1']), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_counters_invalidated_on_commit(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual((u1.post_count(), u2.follower_count()), (0, 0))
+
+        u1.follow(u2)
+        db.session.add(Post(body='hi', author=u1))
+        # nothing changes until the commit
+        self.assertEqual((u1.post_count(), u2.follower_count()), (0, 0))
+        db.session.commit()
+        self.assertEqual((u1.post_count(), u2.follower_count(), u1.followed_count()), (1, 1, 1))
+
+    def test_explore_cache(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add_all([u, Post(body='first post', author=u)])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertIn(b'first post', client.get('/explore').data)
+        self.assertIn('explore:en:1', self.app.cache.local)
+
+        # a new post makes the cached page stale
+        db.session.add(Post(body='second post', author=u))
+        db.session.commit()
+        self.assertIn(b'second post', client.get('/explore').data)
+
+    def test_user_popup_etag(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertEqual(client.get('/user/nobody/popup').status_code, 404)
+
+        first = client.get('/user/susan/popup')
+        self.assertIn(b'0 followers', first.data)
+        etag = first.headers['ETag']
+        second = client.get('/user/susan/popup', headers={'If-None-Match': etag})
+        self.assertEqual(second.status_code, 304)
+
+        # following changes what the popup shows, so the old copy can't be reused
+        u1.follow(u2)
+        db.session.commit()
+        third = client.get('/user/susan/popup', headers={'If-None-Match': etag})
+        self.assertEqual(third.status_code, 200)
+        self.assertIn(b'1 followers', third.data)
+        self.assertNotEqual(third.headers['ETag'], etag)
+
+    def test_single_flight(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        def get():
+            with self.app.app_context():
+                results.append(self.app.cache.get_or_set('slow', compute))
+
+        results = []
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + self.u1.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, etag=None):
+        headers = dict(self.headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client.get(url, headers=headers)
+
+    def test_conditional_get(self):
+        for url in ['/api/users/{}'.format(self.u2.id), '/api/users',
+                    '/api/users/{}/followers'.format(self.u2.id)]:
+            first = self.get(url)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(self.get(url, first.headers['ETag']).status_code, 304, url)
+        self.assertIsNotNone(self.get('/api/users/{}'.format(self.u2.id)).headers.get('Last-Modified'))
+        self.assertEqual(self.get('/api/users/1000').status_code, 404)
+
+        # a new follower changes susan's follower count and her list of followers
+        etags = {url: self.get(url).headers['ETag'] for url in [
+            '/api/users/{}'.format(self.u2.id), '/api/users/{}/followers'.format(self.u2.id)]}
+        self.u1.follow(self.u2)
+        db.session.commit()
+        for url, etag in etags.items():
+            self.assertEqual(self.get(url, etag).status_code, 200, url)
+
+    def test_token_cache(self):
+        token = self.headers['Authorization'].split()[1]
+        self.assertEqual(self.get('/api/users').status_code, 200)
+        self.assertEqual(self.app.token_cache.get(token)[0], self.u1.id)
+
+        # expiry is checked against the cached time, not when the entry was cached
+        self.app.token_cache.set(token, self.u1.id, datetime.utcnow() - timedelta(seconds=1))
+        self.assertEqual(self.get('/api/users').status_code, 401)
+        self.app.token_cache.delete([token])
+
+        # revoking drops the token from the cache straight away
+        self.assertEqual(self.client.delete('/api/tokens', headers=self.headers).status_code, 204)
+        self.assertIsNone(self.app.token_cache.get(token))
+        self.assertEqual(self.get('/api/users').status_code, 401)
+
+    @unittest.skipUnless(redis_available(), 'needs a redis server (set TEST_REDIS_URL)')
+    def test_shared_token_cache(self):
+        from app.token_cache import RedisTokenCache
+        self.app.token_cache = RedisTokenCache(self.app.redis, self.app.config['TOKEN_CACHE_TTL'])
+        self.app.redis.flushdb()
+        token = self.headers['Authorization'].split()[1]
+        self.assertEqual(self.get('/api/users').status_code, 200)
+
+        # another process sees the entry, and sees it go when the token is revoked here
+        other = RedisTokenCache(redis.Redis.from_url(TestConfig.REDIS_URL), self.app.config['TOKEN_CACHE_TTL'])
+        self.assertEqual(other.get(token)[0], self.u1.id)
+        self.assertEqual(self.client.delete('/api/tokens', headers=self.headers).status_code, 204)
+        self.assertIsNone(other.get(token))
+        self.app.redis.flushdb()
+
+    def test_post_representation(self):
+        p1 = Post(body='one', author=self.u2, timestamp=datetime(2020, 5, 17, 10, 2, 34))
+        p2 = Post(body='two', author=self.u2)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        data = self.get('/api/posts/{}'.format(p1.id)).get_json()
+        self.assertEqual(data['timestamp'], '2020-05-17T10:02:34Z')
+        self.assertEqual(data['_links']['self'], '/api/posts/{}'.format(p1.id))
+        self.assertEqual(data['_links']['next'], '/api/posts/{}'.format(p2.id))
+        self.assertNotIn('next', self.get('/api/posts/{}'.format(p2.id)).get_json()['_links'])
+
+        # pages work out next links for all their posts at once
+        self.headers = {'Authorization': 'Bearer ' + self.u2.get_token()}
+        db.session.commit()
+        items = self.get('/api/posts').get_json()['items']
+        self.assertEqual(['next' in item['_links'] for item in items], [True, False])
+        self.assertEqual(items[1]['_links']['previous'], '/api/posts/{}'.format(p1.id))
+
+        # a post by someone else gives the last one a next link, so neither the page nor a batch is still current
+        etags = {url: self.get(url).headers['ETag'] for url in [
+            '/api/posts', '/api/posts?ids={},{}'.format(p1.id, p2.id)]}
+        db.session.add(Post(body='three', author=self.u1))
+        db.session.commit()
+        for url, etag in etags.items():
+            self.assertEqual(self.get(url, etag).status_code, 200, url)
+            self.assertEqual(self.get(url, self.get(url).headers['ETag']).status_code, 304, url)
+
+    def test_fields_and_expand(self):
+        self.u1.follow(self.u2)
+        db.session.add_all([Post(body='one', author=self.u1), Post(body='two', author=self.u1)])
+        db.session.commit()
+
+        data = self.get('/api/users/{}?fields=id,username'.format(self.u2.id)).get_json()
+        self.assertEqual(data, {'id': self.u2.id, 'username': 'susan'})
+        users = self.get('/api/users?fields=username,follower_count').get_json()['items']
+        self.assertEqual(users, [{'username': 'john', 'follower_count': 0},
+                                 {'username': 'susan', 'follower_count': 1}])
+        links = self.get('/api/users?fields=id&per_page=1').get_json()['_links']
+        self.assertIn('fields=id', links['next'])
+
+        # authors come with the page, with just the fields asked for
+        posts = self.get('/api/posts?expand=author&fields=body,author.username,author.post_count').get_json()['items']
+        self.assertEqual(posts, [{'body': 'one', 'author': {'username': 'john', 'post_count': 2}},
+                                 {'body': 'two', 'author': {'username': 'john', 'post_count': 2}}])
+        post = self.get('/api/posts/1?expand=author&fields=id,author.id').get_json()
+        self.assertEqual(post, {'id': 1, 'author': {'id': self.u1.id}})
+
+        # changes to the author change the expanded post
+        response = self.get('/api/posts/1?expand=author')
+        self.assertEqual(self.get('/api/posts/1?expand=author', response.headers['ETag']).status_code, 304)
+        self.u1.about_me = 'hello'
+        db.session.commit()
+        self.assertEqual(self.get('/api/posts/1?expand=author', response.headers['ETag']).status_code, 200)
+
+        for url in ['/api/users?fields=password_hash', '/api/users?expand=posts',
+                    '/api/posts?fields=author.username']:
+            self.assertEqual(self.get(url).status_code, 400, url)
+
+    def test_batch_reads(self):
+        posts = [Post(body='post {}'.format(i), author=self.u2) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        data = self.get('/api/users?ids={},1000,{}'.format(self.u2.id, self.u1.id)).get_json()
+        self.assertEqual([u['username'] for u in data['items']], ['susan', 'john'])
+        self.assertEqual(data['_meta']['missing'], [1000])
+
+        # posts by anyone, with their authors, in the order asked for
+        url = '/api/posts?ids={},{}&expand=author&fields=body,author.username'.format(posts[2].id, posts[0].id)
+        response = self.get(url)
+        self.assertEqual(response.get_json()['items'], [{'body': 'post 2', 'author': {'username': 'susan'}},
+                                                        {'body': 'post 0', 'author': {'username': 'susan'}}])
+        self.assertEqual(self.get(url, response.headers['ETag']).status_code, 304)
+        self.u2.about_me = 'hello'
+        db.session.commit()
+        self.assertEqual(self.get(url, response.headers['ETag']).status_code, 200)
+
+        self.assertEqual(self.get('/api/users?ids=1,two').status_code, 400)
+        self.app.config['API_BATCH_MAX'] = 2
+        self.assertEqual(self.get('/api/users?ids=1,2,3').status_code, 400)
+
+    def test_bulk_create(self):
+        self.assertEqual(self.u1.post_count(), 0)
+        version = self.u1.version
+        response = self.client.post('/api/posts/bulk', headers=self.headers, json=[
+            {'body': 'The quick brown fox jumps over the lazy dog and then runs away into the forest'},
+            {'body': ''},
+            {'body': 'Le renard brun rapide saute par-dessus le chien paresseux et puis il court dans la forêt'},
+            {'body': 'already known', 'language': 'en'}])
+        self.assertEqual(response.status_code, 207)
+        results = response.get_json()['items']
+        self.assertEqual([r['status'] for r in results], [201, 400, 201, 201])
+
+        posts = [Post.query.get(r['id']) for r in results if r['status'] == 201]
+        self.assertEqual([p.body[:6] for p in posts], ['The qu', 'Le ren', 'alread'])
+        self.assertEqual([p.language for p in posts], ['en', 'fr', 'en'])
+        self.assertEqual(results[0]['_links']['self'], '/api/posts/{}'.format(posts[0].id))
+
+        # the author's counters and version move on as if the posts went through the session
+        # the request's session is gone along with the u1 loaded by setUp, so ask for a fresh copy
+        self.assertEqual(User.query.get(self.u1.id).post_count(), 3)
+        self.assertGreater(User.query.get(self.u1.id).version, version)
+
+        self.assertEqual(self.client.post('/api/posts/bulk', headers=self.headers,
+                                          json=[{'body': 'one'}]).status_code, 201)
+        self.assertEqual(self.client.post('/api/posts/bulk', headers=self.headers,
+                                          json={'body': 'one'}).status_code, 400)
+
+    def test_insert_many_ids(self):
+        # batches with the same bodies, at the same moment, each get back the ids of their own rows
+        items = [{'body': 'same', 'language': 'en'}, {'body': 'same', 'language': 'en'}]
+        first = Post.insert_many(self.u1, items)
+        second = Post.insert_many(self.u1, items)
+        db.session.commit()
+        ids = [post.id for post in first + second]
+        self.assertEqual(len(set(ids)), 4)
+        for post in first + second:
+            stored = Post.query.get(post.id)
+            self.assertEqual((stored.user_id, stored.timestamp), (self.u1.id, post.timestamp))
+
+    def test_posts_stream(self):
+        now = datetime.utcnow()
+        for i in range(3):
+            db.session.add(Post(body='post {}'.format(i), author=self.u2, timestamp=now,
+                                updated_at=now + timedelta(seconds=i)))
+        db.session.add(Post(body='not susan', author=self.u1))
+        db.session.commit()
+
+        url = '/api/users/{}/posts.ndjson'.format(self.u2.id)
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([p['body'] for p in lines], ['post 0', 'post 1', 'post 2'])
+
+        # since includes posts changed at that exact time
+        lines = self.get(url + '?since=' + lines[1]['updated_at']).get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['body'] for line in lines], ['post 1', 'post 2'])
+        self.assertEqual(self.get(url + '?since=yesterday').status_code, 400)
+        self.assertEqual(self.get('/api/users/1000/posts.ndjson').status_code, 404)
+
+    def test_changes(self):
+        data = self.get('/api/changes').get_json()
+        self.assertEqual([(c['type'], c['action'], c['id']) for c in data['items']],
+                         [('user', 'create', self.u1.id), ('user', 'create', self.u2.id)])
+        cursor = data['cursor']
+
+        post = Post(body='hello', author=self.u1)
+        db.session.add(post)
+        self.u1.follow(self.u2)
+        db.session.commit()
+        # rolled back changes never make it into the log
+        self.u2.about_me = 'not saved'
+        db.session.flush()
+        db.session.rollback()
+
+        data = self.get('/api/changes?since={}'.format(cursor)).get_json()
+        self.assertEqual(sorted((c['type'], c['action']) for c in data['items']),
+                         [('follow', 'create'), ('post', 'create'), ('user', 'update'), ('user', 'update')])
+        follow = [c for c in data['items'] if c['type'] == 'follow'][0]
+        self.assertEqual((follow['follower_id'], follow['followed_id']), (self.u1.id, self.u2.id))
+        self.assertEqual(data['items'][0]['cursor'], cursor + 1)
+
+        # nothing new - a waiting request gives up after the wait with the same cursor
+        start = time.time()
+        data = self.get('/api/changes?since={}&wait=0.3'.format(data['cursor'])).get_json()
+        self.assertEqual(data['items'], [])
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+        # a change after a gap waits for the gap to fill, unless the gap is old enough to be a rollback
+        cursor = data['cursor']
+        db.session.add(Change(id=cursor + 2, type='post', action='update', object_id=post.id))
+        db.session.commit()
+        self.assertEqual(self.get('/api/changes?since={}'.format(cursor)).get_json()['items'], [])
+        self.app.config['CHANGE_LOG_SETTLE'] = 0
+        self.assertEqual(len(self.get('/api/changes?since={}'.format(cursor)).get_json()['items']), 1)
+
+    def test_changes_skip_last_seen(self):
+        cursor = self.get('/api/changes').get_json()['cursor']
+        # a user clicking around is a new version of them, but not worth a change
+        version = self.u2.version
+        self.u2.last_seen = datetime.utcnow() + timedelta(minutes=5)
+        db.session.commit()
+        self.assertGreater(self.u2.version, version)
+        self.assertEqual(self.get('/api/changes?since={}'.format(cursor)).get_json()['items'], [])
+
+        self.u2.last_seen = datetime.utcnow() + timedelta(minutes=10)
+        self.u2.about_me = 'hello'
+        db.session.commit()
+        data = self.get('/api/changes?since={}&limit=0'.format(cursor)).get_json()
+        self.assertEqual([(c['type'], c['action']) for c in data['items']], [('user', 'update')])
+
+
+class EmailCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_queued_email(self):
+        with mail.record_messages() as outbox:
+            for i in range(3):
+                send_email('hello {}'.format(i), sender='a@example.com',
+                           recipients=['b@example.com'], text_body='hi',
+                           html_body='<p>hi</p>')
+            self.app.mail_queue.join()
+        self.assertEqual(sorted(m.subject for m in outbox),
+                         ['hello 0', 'hello 1', 'hello 2'])
+        self.assertEqual(self.app.mail_queue.stats.as_dict()['sent'], 3)
+
+    def test_delivery_errors(self):
+        from app import email
+        self.app.config['MAIL_RETRY_DELAY'] = 0
+        self.app.config['MAIL_MAX_RETRIES'] = 2
+        attempts = []
+        errors = {
+            'refused': [smtplib.SMTPRecipientsRefused({'x@example.com': (550, b'no such user')})],
+            'rejected': [smtplib.SMTPDataError(554, b'rejected')],
+            # the connection drops once, then the message goes through
+            'dropped': [smtplib.SMTPServerDisconnected('gone'), None],
+        }
+
+        class Connection(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def send(self, msg):
+                attempts.append(msg.subject)
+                error = errors[msg.subject].pop(0) if msg.subject in errors else None
+                if error is not None:
+                    raise error
+
+        messages = [MailMessage(subject, sender='a@example.com', recipients=['x@example.com'])
+                    for subject in ['refused', 'ok', 'rejected', 'dropped', 'fine']]
+        connect = mail.connect
+        mail.connect = Connection
+        try:
+            failed = email.deliver(messages)
+        finally:
+            mail.connect = connect
+        # permanent errors are given up on straight away, and still reported after the retry that followed them
+        self.assertEqual([m.subject for m in failed], ['refused', 'rejected'])
+        self.assertEqual(attempts, ['refused', 'ok', 'rejected', 'dropped', 'dropped', 'fine'])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)